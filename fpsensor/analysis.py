@@ -0,0 +1,212 @@
+'''Offload of analysis (FFT, statistics, ...) to worker processes
+
+Heavy NumPy work in the acquisition process competes for the GIL with the
+receive thread and the userlib position callbacks.  AnalysisExecutor runs
+analysis functions in a process pool instead, handing each batch over
+through a reusable shared-memory block rather than pickling the arrays::
+
+    executor = AnalysisExecutor()
+    future = executor.submit_store(dev.store, spectrum, num=4096)
+    freqs, spectra = future.result()
+
+Analysis functions take (timestamps, values) and must be importable by the
+workers (defined at module level).  Workers are not forked from the
+acquisition process, whose threads may hold locks at the time of the fork,
+so scripts using the executor need an ``if __name__ == '__main__'`` guard.
+'''
+import collections
+import logging
+import multiprocessing
+import threading
+import numpy as np
+
+from concurrent import futures
+from multiprocessing import shared_memory
+
+from .shm import _attach
+
+
+logger = logging.getLogger(__name__)
+
+# shared-memory segments attached by this (worker) process
+_attached = collections.OrderedDict()
+_MAX_ATTACHED = 16
+
+
+def _worker_views(name, num, channels, dtype):
+    shm = _attached.pop(name, None)
+    if shm is None:
+        shm = _attach(name)
+        while len(_attached) >= _MAX_ATTACHED:
+            _attached.popitem(last=False)[1].close()
+    _attached[name] = shm
+
+    timestamps = np.ndarray((num, ), dtype=np.float64, buffer=shm.buf)
+    values = np.ndarray((channels, num), dtype=dtype, buffer=shm.buf,
+                        offset=timestamps.nbytes)
+    return timestamps, values
+
+
+def _run_in_worker(fcn, name, num, channels, dtype, args, kwargs):
+    timestamps, values = _worker_views(name, num, channels, dtype)
+    return fcn(timestamps, values, *args, **kwargs)
+
+
+def _mp_context():
+    '''Start method safe for a multithreaded parent process'''
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+class _Block(object):
+    '''A reusable shared-memory block holding one batch'''
+    def __init__(self, size):
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+
+    @property
+    def size(self):
+        return self.shm.size
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class AnalysisExecutor(object):
+    '''Run analysis functions on sample batches in worker processes
+
+    submit never blocks: when max_pending batches are already in flight the
+    batch is dropped (counted in dropped) and None is returned, so that
+    calling it from an acquisition thread costs at most one copy.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of worker processes
+    max_pending : int, optional
+        Maximum number of batches in flight
+    mp_context : multiprocessing context, optional
+        Defaults to forkserver where available, otherwise spawn
+    '''
+    def __init__(self, max_workers=None, max_pending=4, mp_context=None):
+        if mp_context is None:
+            mp_context = _mp_context()
+        self._pool = futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                 mp_context=mp_context)
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        self._free = []
+        self._pending = 0
+        self.dropped = 0
+
+    def __str__(self):
+        return '<AnalysisExecutor pending={0._pending} ' \
+               'dropped={0.dropped}>'.format(self)
+
+    def _acquire_block(self, nbytes):
+        with self._lock:
+            if self._pending >= self._max_pending:
+                return None
+
+            self._pending += 1
+            for i, block in enumerate(self._free):
+                if block.size >= nbytes:
+                    return self._free.pop(i)
+
+            if self._free:
+                # replace a block that is too small
+                self._free.pop(0).close()
+
+        try:
+            return _Block(nbytes)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+
+    def _release_block(self, block):
+        with self._lock:
+            self._pending -= 1
+            self._free.append(block)
+
+    def submit(self, fcn, timestamps, values, *args, **kwargs):
+        '''Run fcn(timestamps, values, *args, **kwargs) in a worker
+
+        Returns
+        -------
+        future : concurrent.futures.Future or None
+            None if the batch was dropped
+        '''
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values)
+        num = len(timestamps)
+        channels = values.shape[0]
+
+        block = self._acquire_block(max(1, timestamps.nbytes + values.nbytes))
+        if block is None:
+            self.dropped += 1
+            return None
+
+        try:
+            shm_times, shm_values = (
+                np.ndarray((num, ), dtype=np.float64, buffer=block.shm.buf),
+                np.ndarray((channels, num), dtype=values.dtype,
+                           buffer=block.shm.buf, offset=timestamps.nbytes))
+            shm_times[:] = timestamps
+            shm_values[:] = values
+            del shm_times, shm_values
+
+            future = self._pool.submit(_run_in_worker, fcn, block.shm.name,
+                                       num, channels, values.dtype.str,
+                                       args, kwargs)
+        except Exception:
+            self._release_block(block)
+            raise
+
+        future.add_done_callback(lambda fut: self._release_block(block))
+        return future
+
+    def submit_store(self, store, fcn, num=None, *args, **kwargs):
+        '''Run fcn on the newest num samples of a SampleStore'''
+        timestamps, values = store.latest(num)
+        return self.submit(fcn, timestamps, values, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+        with self._lock:
+            for block in self._free:
+                block.close()
+            del self._free[:]
+
+
+def statistics(timestamps, values):
+    '''Per-channel mean, standard deviation and peak-to-peak'''
+    return {'mean': np.mean(values, axis=1),
+            'std': np.std(values, axis=1),
+            'peak_peak': np.ptp(values, axis=1),
+            }
+
+
+def spectrum(timestamps, values, remove_dc=True):
+    '''Amplitude spectra of all channels
+
+    As in fft_plot, the samples are first interpolated onto a uniform time
+    grid.
+
+    Returns
+    -------
+    freqs : np.ndarray, shape (m, )
+    spectra : np.ndarray, shape (channels, m)
+    '''
+    step = np.average(np.diff(timestamps))
+    uniform = timestamps[0] + step * np.arange(len(timestamps))
+    resampled = np.array([np.interp(uniform, timestamps, channel)
+                          for channel in values])
+
+    fft = np.fft.rfft(resampled, axis=1)
+    freqs = np.fft.rfftfreq(len(timestamps), step)
+    spectra = np.abs(fft) / fft.shape[1]
+    if remove_dc:
+        return freqs[1:], spectra[:, 1:]
+    return freqs, spectra
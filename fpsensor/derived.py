@@ -0,0 +1,236 @@
+'''Derived quantities computed on live position streams
+
+A DerivedStage subscribes to the store of a backend and appends, batch by
+batch, the (optionally refractive-index compensated) axes followed by one
+channel per derived quantity to a store of its own::
+
+    stage = fps.derive([Differential(0, 1), Tilt(0, 1, spacing=2e4)],
+                       compensation=RefractiveIndex())
+    stage.set_environment(temperature=21.3, pressure=100.9e3, humidity=42)
+    stage.store.latest()
+
+The derived store offers the same stream interfaces as the backend stores,
+so triggers, plots and servers can be attached to it directly, and no
+consumer has to recompute the quantities on the full history.
+'''
+import logging
+import math
+import numpy as np
+
+from .stream import SampleStore
+
+
+logger = logging.getLogger(__name__)
+
+
+class Quantity(object):
+    '''Base class of derived quantities
+
+    Subclasses implement compute(values), values being the (axes, n) batch
+    of positions, returning an (n, ) array.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return '<{} name={}>'.format(self.__class__.__name__, self.name)
+
+    def compute(self, values):
+        raise NotImplementedError()
+
+
+class Differential(Quantity):
+    '''Displacement of axis a relative to axis b'''
+    def __init__(self, a, b, name=None):
+        if name is None:
+            name = 'diff%d%d' % (a, b)
+        super(Differential, self).__init__(name)
+        self.a = int(a)
+        self.b = int(b)
+
+    def compute(self, values):
+        return values[self.a] - values[self.b]
+
+
+class Tilt(Quantity):
+    '''Tilt angle [rad] from two axes measuring spacing apart
+
+    Parameters
+    ----------
+    a, b : int
+        Axes
+    spacing : float
+        Distance between the two beams, in the units of the positions
+    '''
+    def __init__(self, a, b, spacing, name=None):
+        if name is None:
+            name = 'tilt%d%d' % (a, b)
+        super(Tilt, self).__init__(name)
+        if spacing <= 0:
+            raise ValueError('Invalid beam spacing: {}'.format(spacing))
+        self.a = int(a)
+        self.b = int(b)
+        self.spacing = float(spacing)
+
+    def compute(self, values):
+        return np.arctan2(values[self.a] - values[self.b], self.spacing)
+
+
+def saturation_vapor_pressure(temperature):
+    '''Saturation vapour pressure of water [Pa] at temperature [C] (Magnus)'''
+    return 611.2 * math.exp(17.62 * temperature / (243.12 + temperature))
+
+
+def air_index(wavelength=1.55, temperature=20.0, pressure=101325.0,
+              humidity=50.0):
+    '''Refractive index of air, by the updated Edlen equation
+
+    Bonsch and Potulski, Metrologia 35 (1998) 133.
+
+    Parameters
+    ----------
+    wavelength : float, optional
+        Vacuum wavelength [um]
+    temperature : float, optional
+        Air temperature [C]
+    pressure : float, optional
+        Air pressure [Pa]
+    humidity : float, optional
+        Relative humidity [%]
+    '''
+    sigma2 = (1.0 / wavelength) ** 2
+    t, p = temperature, pressure
+    n_s = 1e-8 * (8091.37 + 2333983.0 / (130.0 - sigma2) +
+                  15518.0 / (38.9 - sigma2))
+    n_tp = (n_s * p * (1.0 + 1e-8 * (0.5953 - 0.009876 * t) * p) /
+            (93214.60 * (1.0 + 0.0036610 * t)))
+    vapor = humidity / 100.0 * saturation_vapor_pressure(t)
+    return 1.0 + n_tp - 1e-10 * vapor * (3.8020 - 0.0384 * sigma2)
+
+
+class RefractiveIndex(object):
+    '''Compensation of the air refractive index
+
+    Positions measured assuming the index `reference` are scaled by
+    reference / n, with n computed from the current environment.  The
+    environment is meant to vary slowly; update() may be called from any
+    thread.
+
+    Parameters
+    ----------
+    wavelength : float, optional
+        Vacuum wavelength of the interferometer [um]
+    reference : float, optional
+        Refractive index assumed by the device
+    temperature, pressure, humidity : float, optional
+        Initial environment [C, Pa, %]
+    '''
+    def __init__(self, wavelength=1.55, reference=1.0, temperature=20.0,
+                 pressure=101325.0, humidity=50.0):
+        self.wavelength = wavelength
+        self.reference = reference
+        self.temperature = temperature
+        self.pressure = pressure
+        self.humidity = humidity
+        self._update_factor()
+
+    def __str__(self):
+        return '<RefractiveIndex n={0.index:.9f} T={0.temperature} ' \
+               'p={0.pressure} RH={0.humidity}>'.format(self)
+
+    def _update_factor(self):
+        self.index = air_index(self.wavelength, self.temperature,
+                               self.pressure, self.humidity)
+        self.factor = self.reference / self.index
+
+    def update(self, temperature=None, pressure=None, humidity=None):
+        '''Set new environmental readings [C, Pa, %]; None keeps a value'''
+        if temperature is not None:
+            self.temperature = temperature
+        if pressure is not None:
+            self.pressure = pressure
+        if humidity is not None:
+            self.humidity = humidity
+        self._update_factor()
+
+    def apply(self, values):
+        return values * self.factor
+
+
+class DerivedStage(object):
+    '''Publish compensated axes and derived quantities as a SampleStore
+
+    Channels of the derived store are the axes of the source store, then
+    one per quantity, in order (see channel_names).
+
+    Parameters
+    ----------
+    store : SampleStore
+        Source of the positions
+    quantities : sequence of Quantity
+    compensation : RefractiveIndex, optional
+        Applied to the axes before the quantities are computed
+    buffer_size : int, optional
+        Capacity of the derived store; defaults to that of the source
+    '''
+    def __init__(self, store, quantities, compensation=None,
+                 buffer_size=None):
+        self._source = store
+        self._quantities = list(quantities)
+        self._compensation = compensation
+        self._axes = store.channels
+
+        if buffer_size is None:
+            buffer_size = store.capacity
+        self._store = SampleStore(buffer_size,
+                                  channels=self._axes + len(self._quantities))
+
+        store.subscribe(self._process)
+        store.subscribe_gaps(self._forward_gap)
+
+    def __str__(self):
+        return '<DerivedStage channels={}>'.format(self.channel_names)
+
+    @property
+    def store(self):
+        '''The SampleStore of axes and derived quantities'''
+        return self._store
+
+    @property
+    def compensation(self):
+        return self._compensation
+
+    @property
+    def channel_names(self):
+        return (['axis%d' % axis for axis in range(self._axes)] +
+                [q.name for q in self._quantities])
+
+    def channel(self, name):
+        '''Index of a channel of the derived store by name'''
+        return self.channel_names.index(name)
+
+    def set_environment(self, temperature=None, pressure=None,
+                        humidity=None):
+        '''Update the environment of the refractive index compensation'''
+        if self._compensation is None:
+            raise ValueError('No refractive index compensation configured')
+        self._compensation.update(temperature=temperature,
+                                  pressure=pressure, humidity=humidity)
+
+    def _process(self, timestamps, values):
+        axes = np.asarray(values, dtype=np.float64)
+        if self._compensation is not None:
+            axes = self._compensation.apply(axes)
+
+        out = np.empty((self._store.channels, len(timestamps)))
+        out[:self._axes] = axes
+        for i, quantity in enumerate(self._quantities):
+            out[self._axes + i] = quantity.compute(axes)
+        self._store.append(timestamps, out)
+
+    def _forward_gap(self, gap):
+        self._store.mark_gap(gap.start, gap.end, gap.reason)
+
+    def close(self):
+        self._source.unsubscribe(self._process)
+        self._source.unsubscribe_gaps(self._forward_gap)
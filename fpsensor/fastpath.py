@@ -0,0 +1,121 @@
+'''Low-latency consumer hooks for closed-loop control
+
+A fast path is called with every decoded batch, in the acquisition thread,
+before the samples are queued or stored: in the position callback of the
+userlib, and right after a SYNC_POS ACK is decoded by the TCP receive
+thread::
+
+    def control(timestamps, values):
+        stage.correct(values[0, -1])
+
+    fast = fps.add_fast_path(control, budget=0.5e-3)
+    ...
+    print(fast.stats)
+
+Each invocation is timed from the arrival of the data at the host to the
+return of the callback.  Latencies over the budget count as overruns.
+The callback holds up acquisition while it runs: it should do no more
+than compute and send a correction.
+'''
+import collections
+import logging
+import time
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+LatencyStats = collections.namedtuple(
+    'LatencyStats', 'count mean jitter max overruns errors')
+LatencyStats.__doc__ = '''Latency of a fast path since its last reset
+
+count : int
+    Invocations
+mean, jitter, max : float
+    Mean, standard deviation and maximum of the latency [s]
+overruns : int
+    Invocations over the budget
+errors : int
+    Invocations that raised
+'''
+
+
+class FastPath(object):
+    '''A latency-budgeted callback run in the acquisition thread
+
+    Parameters
+    ----------
+    callback : callable
+        callback(timestamps, values), values of shape (channels, n)
+    budget : float, optional
+        Latency budget [s] from data arrival to callback return
+    on_overrun : callable, optional
+        on_overrun(latency), called after an invocation over budget
+    history : int, optional
+        Number of recent latencies kept for percentile()
+    '''
+    def __init__(self, callback, budget=1e-3, on_overrun=None,
+                 history=1000):
+        self.callback = callback
+        self.budget = budget
+        self.on_overrun = on_overrun
+        self._history = int(history)
+        self.reset()
+
+    def __str__(self):
+        return '<FastPath callback={0.callback!r} budget={0.budget} ' \
+               'stats={0.stats}>'.format(self)
+
+    def reset(self):
+        self._count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._max = 0.0
+        self.overruns = 0
+        self.errors = 0
+        self.last_overrun = None
+        self.recent = collections.deque(maxlen=self._history)
+
+    def __call__(self, timestamps, values, arrival):
+        '''Run the callback on data that arrived at time.perf_counter()'''
+        try:
+            self.callback(timestamps, values)
+        except Exception:
+            self.errors += 1
+            logger.exception('Fast path %r failed', self.callback)
+
+        latency = time.perf_counter() - arrival
+
+        # running mean and variance (Welford)
+        self._count += 1
+        delta = latency - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (latency - self._mean)
+        if latency > self._max:
+            self._max = latency
+        self.recent.append(latency)
+
+        if latency > self.budget:
+            self.overruns += 1
+            self.last_overrun = latency
+            if self.on_overrun is not None:
+                try:
+                    self.on_overrun(latency)
+                except Exception:
+                    logger.exception('Overrun handler %r failed',
+                                     self.on_overrun)
+
+    @property
+    def stats(self):
+        jitter = 0.0
+        if self._count > 1:
+            jitter = (self._m2 / (self._count - 1)) ** 0.5
+        return LatencyStats(self._count, self._mean, jitter, self._max,
+                            self.overruns, self.errors)
+
+    def percentile(self, q):
+        '''Percentile q of the recent latencies [s]'''
+        if not self.recent:
+            return None
+        return float(np.percentile(list(self.recent), q))
@@ -0,0 +1,207 @@
+'''Raw telegram capture
+
+Every telegram sent or received is appended, with a time.monotonic()
+timestamp, to a compact binary log::
+
+    magic  b'FPSCAP1\\n'
+    record <d time> <B direction> <H length> <length bytes of telegram>
+
+Recording only copies the telegram and appends it to a deque; packing and
+writing happen in a separate thread.  read_capture decodes a whole log at
+once, vectorized, for offline analysis.
+'''
+import collections
+import struct
+import threading
+import time
+import numpy as np
+
+from .telegram import (ACK, ID_FPS_SYNC_POS, UcTelegram,
+                       decode_sync_positions)
+
+
+MAGIC = b'FPSCAP1\n'
+RECORD = struct.Struct('<dBH')
+
+TX = 0
+RX = 1
+
+# number of data words kept per record by read_capture
+DATA_WORDS = 6
+
+capture_dtype = np.dtype([('time', '<f8'),
+                          ('direction', 'u1'),
+                          ('length', '<i4'),
+                          ('opcode', '<i4'),
+                          ('address', '<i4'),
+                          ('index', '<i4'),
+                          ('sequence_num', '<i4'),
+                          ('reason', '<i4'),
+                          ('num_data', '<i4'),
+                          ('data', '<i4', (DATA_WORDS, )),
+                          ])
+
+
+class TelegramCapture(object):
+    '''Log telegrams to a file from a background writer thread
+
+    Parameters
+    ----------
+    filename : str
+    flush_interval : float, optional
+        Seconds between writes of the buffered telegrams
+    '''
+    def __init__(self, filename, flush_interval=0.5):
+        self._filename = filename
+        self._flush_interval = flush_interval
+        self._pending = collections.deque()
+        self._running = True
+        self.count = 0
+
+        self._file = open(filename, 'wb')
+        self._file.write(MAGIC)
+
+        self._thread = threading.Thread(target=self._write_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __str__(self):
+        return '<TelegramCapture filename={0._filename} ' \
+               'count={0.count}>'.format(self)
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def record(self, direction, buf, length=None):
+        '''Queue a telegram (all of buf, or its first length bytes)'''
+        data = bytes(buf) if length is None else bytes(buf[:length])
+        self._pending.append((time.monotonic(), direction, data))
+
+    def _flush(self):
+        # deque appends and pops are thread-safe, so record() needs no
+        # lock; telegrams recorded while draining wait for the next flush
+        pending = []
+        for _ in range(len(self._pending)):
+            pending.append(self._pending.popleft())
+        if not pending:
+            return
+
+        chunks = []
+        for timestamp, direction, data in pending:
+            chunks.append(RECORD.pack(timestamp, direction, len(data)))
+            chunks.append(data)
+        self._file.write(b''.join(chunks))
+        self._file.flush()
+        self.count += len(pending)
+
+    def _write_loop(self):
+        while self._running:
+            time.sleep(self._flush_interval)
+            self._flush()
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self._flush()
+        self._file.close()
+
+
+def _index_records(filename):
+    '''Read a capture and locate its records
+
+    Returns
+    -------
+    raw : bytes
+    index : list of (time, direction, offset, length)
+    '''
+    with open(filename, 'rb') as f:
+        raw = f.read()
+
+    if not raw.startswith(MAGIC):
+        raise ValueError('{} is not a telegram capture'.format(filename))
+
+    index = []
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(raw):
+        timestamp, direction, length = RECORD.unpack_from(raw, offset)
+        offset += RECORD.size
+        if offset + length > len(raw):
+            # truncated by a crash mid-write
+            break
+        index.append((timestamp, direction, offset, length))
+        offset += length
+    return raw, index
+
+
+def iter_capture(filename):
+    '''Yield (time, direction, telegram bytes) for every record'''
+    raw, index = _index_records(filename)
+    for timestamp, direction, offset, length in index:
+        yield timestamp, direction, raw[offset:offset + length]
+
+
+def read_capture(filename):
+    '''Decode a whole capture into a structured array (see capture_dtype)
+
+    All records are decoded at once with numpy.  reason is -1 for anything
+    but acknowledgements, and only the first DATA_WORDS data words are
+    kept.
+    '''
+    raw, index = _index_records(filename)
+    result = np.zeros(len(index), dtype=capture_dtype)
+    if not index:
+        return result
+
+    times, directions, offsets, lengths = (np.array(col)
+                                           for col in zip(*index))
+    result['time'] = times
+    result['direction'] = directions
+
+    # gather the leading words of every telegram into one (n, words) array
+    num_words = UcTelegram.sequence_num.offset // 4 + 2 + DATA_WORDS
+    padded = np.frombuffer(raw + bytes(4 * num_words), dtype=np.uint8)
+    byte_idx = offsets[:, np.newaxis] + np.arange(4 * num_words)
+    words = padded[byte_idx].copy().view('<i4')
+    num_valid = lengths // 4
+
+    header = words[:, :5]
+    short = num_valid < 5
+    result['length'] = np.where(short, -1, header[:, 0])
+    result['opcode'] = header[:, 1]
+    result['address'] = header[:, 2]
+    result['index'] = header[:, 3]
+    result['sequence_num'] = header[:, 4]
+
+    is_ack = (result['opcode'] == ACK) & (num_valid > 5)
+    result['reason'] = np.where(is_ack, words[:, 5], -1)
+
+    data_start = np.where(is_ack, 6, 5)
+    result['num_data'] = np.maximum(num_valid - data_start, 0)
+    col = data_start[:, np.newaxis] + np.arange(DATA_WORDS)
+    data = np.take_along_axis(words, np.minimum(col, num_words - 1), axis=1)
+    data[col >= num_valid[:, np.newaxis]] = 0
+    result['data'] = data
+    return result
+
+
+def capture_positions(records):
+    '''Synchronized positions [um] from the received SYNC_POS ACKs
+
+    Parameters
+    ----------
+    records : np.ndarray
+        As returned by read_capture
+
+    Returns
+    -------
+    timestamps : np.ndarray, shape (n, )
+    values : np.ndarray, shape (3, n)
+    '''
+    sel = records[(records['direction'] == RX) &
+                  (records['opcode'] == ACK) &
+                  (records['address'] == ID_FPS_SYNC_POS) &
+                  (records['num_data'] >= 6)]
+    data = sel['data']
+    values = decode_sync_positions(data[:, 0::2].T, data[:, 1::2].T) / 1e6
+    return sel['time'], values
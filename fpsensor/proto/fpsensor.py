@@ -1,4 +1,6 @@
 from __future__ import print_function
+import errno
+import logging
 import socket
 import threading
 import time
@@ -6,28 +8,118 @@ import numpy as np
 
 from ctypes import (c_int32, sizeof)
 
-from .telegram import (REASON_OK, reason_strings, MAXSIZE)
+from .telegram import (REASON_OK, reason_strings, MAXSIZE,
+                       decode_sync_positions)
 from .telegram import (UcTelegram, UcGetTelegram, UcSetTelegram,
                        telegram_types, data_offsets)
-from .telegram import (ID_FPS_CHAN_POSITION, ID_FPS_SYNC_POS, ID_FPS_TELL_OFF)
-
-
-class FPSensor(object):
-    def __init__(self, host, port=2101):
+from .telegram import (ID_FPS_CHAN_POSITION, ID_FPS_SYNC_POS, ID_FPS_TELL_OFF,
+                       ID_FPS_SAMPLE_TIME)
+from .capture import (TelegramCapture, TX, RX)
+from .. import rate
+from ..stream import (SampleStore, StreamSource)
+from ..timing import ClockCorrelator
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionLost(Exception):
+    pass
+
+
+class TelegramError(Exception):
+    pass
+
+
+class _Batch(object):
+    '''Acknowledgements awaited for a batch of telegrams'''
+    def __init__(self, telegrams):
+        self.telegrams = list(telegrams)
+        self.acks = [None] * len(self.telegrams)
+        self.remaining = len(self.telegrams)
+        self.done = threading.Event()
+
+    def set(self, position, tel):
+        if self.acks[position] is None:
+            self.acks[position] = (tel.reason, list(tel.data))
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.done.set()
+
+
+class FPSensor(StreamSource):
+    '''FPS3010 over the TCP telegram protocol
+
+    If the connection drops or stalls (requests go unacknowledged for
+    stall_timeout seconds) the receive thread reconnects with exponential
+    backoff, re-sends the requests that were in flight and the session
+    settings (e.g. tell_off), and marks the outage as a gap in the store.
+
+    Parameters
+    ----------
+    host : str
+    port : int, optional
+    buffer_size : int, optional
+        Number of synchronized position samples kept in the store
+    reconnect : bool, optional
+        Reconnect automatically when the connection is lost
+    stall_timeout : float, optional
+        Seconds without an expected acknowledgement before reconnecting
+    max_backoff : float, optional
+        Upper limit of the delay between reconnection attempts
+    connect : bool, optional
+        Connect immediately; otherwise run() connects
+    store_dtype : np.dtype, optional
+        Storage type of the picometre counts, see SampleStore.  np.int32
+        halves the memory by storing deltas from the first sample, which
+        fit within +-2.1 mm.
+    '''
+    _SOCKET_TIMEOUT = 0.25
+    _MIN_BACKOFF = 0.1
+
+    def __init__(self, host, port=2101, buffer_size=20000, reconnect=True,
+                 stall_timeout=2.0, max_backoff=10.0, connect=True,
+                 store_dtype=np.int64):
         self._host = host
         self._port = port
+        self._reconnect = reconnect
+        self._stall_timeout = stall_timeout
+        self._max_backoff = max_backoff
 
-        self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._s.connect((self._host, self._port))
+        self._s = None
         self._seq = 129
+        self._seq_lock = threading.Lock()
 
-        # self._requests = {}
+        self._requests = {}
+        self._waiters = {}
+        self._session = {}
         self._thread = None
+        self._poll_thread = None
+        self._poll_period = None
+        self._polling = False
+        self._poll_indices = {}
+        self._clock = None
+        # time.time() - time.monotonic(), when polling started
+        self._epoch_offset = 0.0
+        self._fast_paths = []
+        self._arrival = None
         self._positions = [0.0, 0.0, 0.0]
         self._running = False
+        self._last_ack = None
+        # send time of the newest request acknowledged
+        self._last_acked_sent = 0.0
         self.data = {}
+        self.outages = []
         self._s_lock = threading.Lock()
-        self.positions = np.zeros((4, 20000), dtype=np.float)
+        # guards _requests, _waiters and _poll_indices, shared by the user,
+        # poll and receive threads
+        self._req_lock = threading.Lock()
+        # synchronized positions are kept as picometre counts
+        self._store = SampleStore(buffer_size, dtype=store_dtype, scale=1e-6)
+        self._capture = None
+
+        if connect:
+            self._connect()
 
     @property
     def host(self):
@@ -41,10 +133,153 @@ class FPSensor(object):
     def socket(self):
         return self._s
 
+    @property
+    def connected(self):
+        return self._s is not None
+
+    @property
+    def clock(self):
+        '''ClockCorrelator of poll slots on time.monotonic(), while polling'''
+        return self._clock
+
+    @property
+    def store(self):
+        '''The SampleStore of synchronized positions'''
+        return self._store
+
+    @property
+    def positions(self):
+        '''(4, n) array of timestamps and the three axis positions [um]'''
+        return self._store.data
+
+    def _connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.settimeout(self._SOCKET_TIMEOUT * 4)
+            s.connect((self._host, self._port))
+            s.settimeout(self._SOCKET_TIMEOUT)
+        except Exception:
+            s.close()
+            raise
+
+        with self._s_lock:
+            self._s = s
+        self._last_ack = time.time()
+
+    def _disconnect(self):
+        with self._s_lock:
+            s, self._s = self._s, None
+
+        if s is not None:
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            s.close()
+
+    def _reconnect_loop(self, reason):
+        '''Reconnect with backoff, then resume requests and mark the gap'''
+        lost_at = time.time()
+        if len(self._store):
+            lost_at = self._store.latest(1)[0][0]
+
+        logger.warning('Connection to %s:%d lost (%s); reconnecting',
+                       self._host, self._port, reason)
+        self._disconnect()
+
+        backoff = self._MIN_BACKOFF
+        refused = False
+        while self._running:
+            try:
+                self._connect()
+            except socket.error as ex:
+                # refused while the firmware restarts, vs. unreachable
+                refused = refused or ex.errno in (errno.ECONNREFUSED,
+                                                  errno.ECONNRESET)
+                logger.debug('Reconnection failed: %s (retry in %.1fs)',
+                             ex, backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self._max_backoff)
+            else:
+                break
+        else:
+            return
+
+        resumed_at = time.time()
+        self.outages.append((lost_at, resumed_at, reason, refused))
+        self._store.mark_gap(lost_at, resumed_at, reason)
+        logger.warning('Reconnected to %s:%d after %.1fs%s', self._host,
+                       self._port, resumed_at - lost_at,
+                       ' (device restarted?)' if refused else '')
+        self._resume()
+
+    def _resume(self):
+        '''Re-send the session settings and the requests in flight'''
+        # repeated polls collapse to one request per address, while every
+        # telegram of a batch is awaited and re-sent
+        in_flight = {}
+        with self._req_lock:
+            for tel, t0 in sorted(self._requests.values(),
+                                  key=lambda r: r[1]):
+                if tel.sequence_num in self._waiters:
+                    key = tel.sequence_num
+                else:
+                    key = (tel.opcode, tel.address, tel.index)
+                in_flight[key] = tel
+            self._requests.clear()
+            # re-sent polls are answered off schedule
+            self._poll_indices.clear()
+
+        for address, index, data in self._session.values():
+            self._send(self._set_telegram(address=address, index=index,
+                                          data=data))
+
+        resend = []
+        for tel in in_flight.values():
+            with self._req_lock:
+                waiter = self._waiters.pop(tel.sequence_num, None)
+                tel.sequence_num = self._seq_num
+                if waiter is not None:
+                    self._waiters[tel.sequence_num] = waiter
+            self._track(tel)
+            resend.append(tel)
+
+        if resend:
+            self._send_all(resend)
+
+    def _track(self, tel):
+        with self._req_lock:
+            self._requests[tel.sequence_num] = (tel, time.time())
+
+    def _is_stalled(self):
+        '''Requests have gone unacknowledged for too long
+
+        Requests overtaken by the acknowledgement of a later one were lost
+        by the device, and do not count.
+        '''
+        now = time.time()
+        if (now - self._last_ack) <= self._stall_timeout:
+            return False
+
+        with self._req_lock:
+            pending = [t0 for tel, t0 in self._requests.values()
+                       if t0 > self._last_acked_sent]
+        return bool(pending) and (now - min(pending)) > self._stall_timeout
+
+    def _expire(self, sent):
+        '''Drop overtaken requests older than the stall timeout'''
+        expiry = min(sent, time.time() - self._stall_timeout)
+        for seq, (tel, t0) in list(self._requests.items()):
+            if t0 < expiry:
+                del self._requests[seq]
+                self._poll_indices.pop(seq, None)
+
     @property
     def _seq_num(self):
-        self._seq = ((self._seq + 1) % 10000) + 1
-        return self._seq
+        # allocated from the user, poll and receive threads
+        with self._seq_lock:
+            self._seq = ((self._seq + 1) % 10000) + 1
+            return self._seq
 
     def _get_telegram(self, address=0, index=0):
         tel = UcGetTelegram()
@@ -68,8 +303,23 @@ class FPSensor(object):
         return tel
 
     def _check_response(self, tel):
+        ack_time = time.monotonic()
+        self._last_ack = time.time()
+        with self._req_lock:
+            request = self._requests.pop(tel.sequence_num, None)
+            waiter = self._waiters.pop(tel.sequence_num, None)
+            poll_index = self._poll_indices.pop(tel.sequence_num, None)
+            if request is not None:
+                sent = request[1]
+                self._last_acked_sent = max(self._last_acked_sent, sent)
+                if self._requests:
+                    self._expire(sent)
+        if waiter is not None:
+            batch, position = waiter
+            batch.set(position, tel)
+
         if tel.reason != REASON_OK:
-            print('response', reason_strings.get(tel.reason, None))
+            logger.debug('response %s', reason_strings.get(tel.reason, None))
             # req_num = tel.sequence_num
             # try:
             #     req, t0 = self._requests.pop(req_num)
@@ -84,97 +334,246 @@ class FPSensor(object):
             self.query_position(tel.index)
         elif tel.address == ID_FPS_SYNC_POS:
             # print('data', list(tel.data))
-            self._positions[0] = tel.data[0] / 1e6
-            self._positions[1] = tel.data[2] / 1e6
-            self._positions[2] = tel.data[4] / 1e6
-
-            for i in range(4):
-                self.positions[i, :-1] = self.positions[i, 1:]
-                if i == 0:
-                    self.positions[i, -1] = time.time()
-                else:
-                    self.positions[i, -1] = self._positions[i - 1]
+            # 48-bit picometres, split into lower 32 and upper 16 bits
+            pm = decode_sync_positions(tel.data[0:6:2], tel.data[1:6:2])
+            self._positions[:] = (pm * 1e-6).tolist()
+
+            timestamp = self._last_ack
+            clock = self._clock
+            correlate = (poll_index is not None and clock is not None)
+            # the clock is fitted on the monotonic clock; stored timestamps
+            # are epoch times
+            epoch_offset = self._epoch_offset
+            if correlate and clock.ready:
+                timestamp = float(clock.to_host(poll_index)) + epoch_offset
+
+            # fast paths first, on the current fit, as refitting takes time
+            fast_paths = self._fast_paths
+            if fast_paths:
+                arrival = self._arrival
+                if arrival is None:
+                    arrival = time.perf_counter()
+                timestamps = np.array([timestamp])
+                values = np.array(self._positions)[:, np.newaxis]
+                for fast in fast_paths:
+                    fast(timestamps, values, arrival)
+            self._arrival = None
+
+            if correlate:
+                clock.update(poll_index, ack_time)
+                timestamp = float(clock.to_host(poll_index)) + epoch_offset
+
+            self._store.append([timestamp], pm[:, np.newaxis])
 
             # print('Axis 0 Position: %f' % (pos, ))
             # print('Axis 1 Position: %f' % (tel.data[0] / 1e4))
             # print('Axis 2 Position: %f' % (tel.data[0] / 1e4))
         else:
             self.data[(tel.address, tel.index)] = list(tel.data)
-            print('unknown addr response (0x{0.address:x}:{0.index:d}) '
-                  'data={1:s}?'.format(tel, list(tel.data)))
-            print('telegram:', tel)
+            logger.debug('unknown addr response (0x%x:%d) data=%s? %s',
+                         tel.address, tel.index, list(tel.data), tel)
+
+    def _recv_into(self, view, nbytes, idle_ok=False):
+        '''Receive exactly nbytes into view
+
+        Raises socket.timeout only if idle_ok and nothing was received yet,
+        and ConnectionLost if the rest of a telegram does not arrive within
+        the stall timeout.
+        '''
+        got = 0
+        progress = time.time()
+        while got < nbytes:
+            s = self._s
+            if s is None or not self._running:
+                raise ConnectionLost('disconnected')
+
+            try:
+                received = s.recv_into(view[got:], nbytes - got)
+            except socket.timeout:
+                if idle_ok and got == 0:
+                    raise
+                elif time.time() - progress > self._stall_timeout:
+                    raise ConnectionLost('stalled within a telegram')
+                continue
 
-    def _receive_loop(self):
-        # use a single buffer for the base telegram + the upcast one
-        buf = bytearray(MAXSIZE)
+            if received == 0:
+                raise ConnectionLost('closed by peer')
+            got += received
+            progress = time.time()
 
-        base_tel = UcTelegram.from_buffer(buf)
+    def _receive_telegram(self, buf, base_tel):
+        mv = memoryview(buf)
+        self._recv_into(mv, UcTelegram.address.offset, idle_ok=True)
 
-        while self._running:
-            self._s.recv_into(base_tel, UcTelegram.address.offset)
+        if base_tel.length <= 0:
+            logger.debug('? length=%d', base_tel.length)
+            return
+        elif base_tel.opcode not in telegram_types:
+            logger.debug('? unknown telegram type? %d', base_tel.opcode)
+            return
 
-            if base_tel.length <= 0:
-                print('? length=', base_tel.length)
-                continue
-            elif base_tel.opcode not in telegram_types:
-                print('? unknown telegram type?', base_tel.opcode)
-                continue
+        tel_type = telegram_types[base_tel.opcode]
+        data_offset = data_offsets[base_tel.opcode]
 
-            tel_type = telegram_types[base_tel.opcode]
-            data_offset = data_offsets[base_tel.opcode]
+        data_size = ((base_tel.length - data_offset) >> 2)
+        # data_size /= sizeof(int32) ?
 
-            data_size = ((base_tel.length - data_offset) >> 2)
-            # data_size /= sizeof(int32) ?
+        tel = tel_type(data_size).from_buffer(buf)
 
-            tel = tel_type(data_size).from_buffer(buf)
+        # length doesn't include itself
+        self._recv_into(mv[UcTelegram.address.offset:], tel.length - 4)
 
-            # length doesn't include itself
-            mv = memoryview(buf)
-            self._s.recv_into(mv[UcTelegram.address.offset:],
-                              tel.length - 4
-                              )
+        self._arrival = time.perf_counter()
+        capture = self._capture
+        if capture is not None:
+            capture.record(RX, buf, tel.length + 4)
 
-            # TODO make classes top-level, subclass, etc.
-            if 'Ack' in tel.__class__.__name__:
-                self._check_response(tel)
-            else:
-                pass
-                # if tel.index == 0:
-                #     print(tel)
+        # TODO make classes top-level, subclass, etc.
+        if 'Ack' in tel.__class__.__name__:
+            self._check_response(tel)
+        else:
+            pass
+            # if tel.index == 0:
+            #     print(tel)
+
+            # old_value = self.data.get((tel.address, tel.index), None)
+            # if tel.index == 0 and old_value != tel.data[0]:
+            #     print('[%s] %s -> %s'
+            #           '' % (tel.address, old_value, tel.data[0]))
 
-                # old_value = self.data.get((tel.address, tel.index), None)
-                # if tel.index == 0 and old_value != tel.data[0]:
-                #     print('[%s] %s -> %s'
-                #           '' % (tel.address, old_value, tel.data[0]))
+        self.data[(tel.address, tel.index)] = tel.data[0]
 
-            self.data[(tel.address, tel.index)] = tel.data[0]
+    def _receive_loop(self):
+        # use a single buffer for the base telegram + the upcast one
+        buf = bytearray(MAXSIZE)
 
-            # for id_, (req, t0) in list(self._requests.items()):
-            #     if (time.time() - t0) > 1.0:
-            #         # self._requests.pop(id_)
+        base_tel = UcTelegram.from_buffer(buf)
 
-            #         req.sequence_num = self._seq_num
-            #         self._requests[req.sequence_num] = (req, time.time())
-            #         self._send(req)
+        while self._running:
+            reason = None
+            try:
+                self._receive_telegram(buf, base_tel)
+            except socket.timeout:
+                pass
+            except (ConnectionLost, socket.error) as ex:
+                reason = str(ex)
+            except Exception:
+                # keep receiving; a dead thread would stall silently
+                logger.exception('Failed to handle telegram')
+
+            try:
+                if reason is None and self._is_stalled():
+                    reason = 'acknowledgements stalled'
+
+                if reason is None or not self._running:
+                    continue
+                elif not self._reconnect:
+                    logger.error('Connection lost (%s)', reason)
+                    self._disconnect()
+                    self._running = False
+                    break
+
+                self._reconnect_loop(reason)
+            except Exception:
+                logger.exception('Failed to check or restore the connection')
 
     def _send(self, buf):
+        self._send_all([buf])
+
+    def _send_all(self, telegrams):
+        '''Send telegrams with a single write'''
         with self._s_lock:
-            self._s.sendall(buf)
+            if self._s is None:
+                # dropped; in-flight requests are re-sent on reconnection
+                return
+
+            capture = self._capture
+            if capture is not None:
+                for tel in telegrams:
+                    capture.record(TX, tel)
+
+            try:
+                if len(telegrams) == 1:
+                    self._s.sendall(telegrams[0])
+                else:
+                    self._s.sendall(b''.join(bytes(tel)
+                                             for tel in telegrams))
+            except socket.error as ex:
+                logger.debug('Send failed: %s', ex)
+                # wake up the receive thread, which handles reconnection
+                try:
+                    self._s.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
 
     def query_position(self, axis):
         tel = self._get_telegram(address=ID_FPS_CHAN_POSITION, index=axis)
-        # self._requests[tel.sequence_num] = (tel, time.time())
+        self._track(tel)
         self._send(tel)
 
     def query_positions(self):
+        self._query_sync_positions()
+
+    def _query_sync_positions(self, poll_index=None):
         tel = self._get_telegram(address=ID_FPS_SYNC_POS, index=0)
-        # self._requests[tel.sequence_num] = (tel, time.time())
+        if poll_index is not None:
+            with self._req_lock:
+                self._poll_indices[tel.sequence_num] = poll_index
+        self._track(tel)
         self._send(tel)
 
+    def _poll_loop(self, period):
+        # polls are numbered by schedule slot, so that the ACK times can be
+        # correlated with the schedule to timestamp the samples
+        with self._req_lock:
+            self._poll_indices.clear()
+        self._epoch_offset = time.time() - time.monotonic()
+        self._clock = ClockCorrelator(period=period)
+        index = 0
+        next_time = time.monotonic()
+        while self._polling:
+            # skip requests while disconnected; the receive thread re-sends
+            # the last one after reconnecting
+            if self._s is not None:
+                self._query_sync_positions(poll_index=index)
+
+            index += 1
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:
+                # fell behind; skip the missed slots rather than bursting
+                missed = int(-delay // period)
+                index += missed
+                next_time += missed * period
+
+    def start_polling(self, period=0.005):
+        '''Query synchronized positions every period seconds'''
+        if self._poll_thread is not None:
+            return
+
+        self.run()
+        self._polling = True
+        self._poll_period = period
+        self._poll_thread = threading.Thread(target=self._poll_loop,
+                                             args=(period, ))
+        self._poll_thread.daemon = True
+        self._poll_thread.start()
+
+    def stop_polling(self):
+        self._polling = False
+        if self._poll_thread is not None:
+            self._poll_thread.join()
+            self._poll_thread = None
+
     def run(self):
         if self._thread is not None:
             return
 
+        if self._s is None:
+            self._connect()
+
         self._running = True
 
         self._thread = threading.Thread(target=self._receive_loop)
@@ -182,23 +581,203 @@ class FPSensor(object):
         self._thread.start()
 
     def stop(self):
+        self.stop_polling()
+        self.stop_capture()
         self._running = False
-        self._thread = None
+        if self._thread is not None:
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            self._thread = None
+        self._disconnect()
+
+    def start_capture(self, filename, flush_interval=0.5):
+        '''Log all telegrams sent and received, see proto.capture'''
+        self.stop_capture()
+        self._capture = TelegramCapture(filename,
+                                        flush_interval=flush_interval)
+        return self._capture
+
+    def stop_capture(self):
+        capture, self._capture = self._capture, None
+        if capture is not None:
+            capture.close()
+
+    def _set_session(self, address, index, data, wait=False):
+        '''Send a setting and re-apply it after every reconnection'''
+        self._session[(address, index)] = (address, index, list(data))
+        if wait:
+            self.write_registers([((address, index), data)])
+        else:
+            tel = self._set_telegram(address=address, index=index, data=data)
+            self._send(tel)
+
+    @property
+    def sample_time(self):
+        '''Device sample time [ms], read from the sensor'''
+        ticks, = self.read_registers([ID_FPS_SAMPLE_TIME])[0][:1]
+        return ticks * rate.TIME_SCALE_MS
+
+    def measure_sample_rate(self, duration=1.0):
+        '''Measure the polled stream, see rate.measure_rate'''
+        nominal = None
+        if self._poll_period is not None:
+            nominal = self._poll_period * 1e3
+        return rate.measure_rate(self._store, duration, nominal=nominal)
+
+    def set_sample_rate(self, sample_rate, verify=True, duration=1.0):
+        '''Set the sample time [ms] and poll at the same period
+
+        Replaces the raw register access of sample time 0x68e.
+
+        Returns
+        -------
+        report : rate.RateReport or None
+            Measured delivery, if verify
+        '''
+        ticks = rate.to_ticks(sample_rate)
+        if ticks < 1:
+            raise ValueError('Invalid sample rate ({} ms)'.format(sample_rate))
+
+        # the register write is acknowledged through the receive thread
+        self.run()
+        self._set_session(ID_FPS_SAMPLE_TIME, 0, [ticks], wait=True)
+        self.stop_polling()
+        self.start_polling(ticks * rate.TIME_SCALE_MS * 1e-3)
+
+        if verify:
+            return self.measure_sample_rate(duration)
+
+    def auto_tune_sample_rate(self, min_period=0.1, max_period=100.0,
+                              duration=1.0, max_drop=0.02):
+        '''Find the shortest sample time [ms] the host keeps up with
+
+        The sensor is left polling at the period found.
+
+        Returns
+        -------
+        report : rate.RateReport or None
+        '''
+        def probe(period):
+            return self.set_sample_rate(period, duration=duration)
+
+        return rate.auto_tune(probe, min_period, max_period,
+                              max_drop=max_drop)
 
     def tell_off(self):
-        tel = self._set_telegram(address=ID_FPS_TELL_OFF, index=0, data=[1])
-        # self._requests[tel.sequence_num] = (tel, time.time())
-        self._send(tel)
+        self._set_session(ID_FPS_TELL_OFF, 0, [1])
 
     def align(self, enabled):
-        tel = self._set_telegram(address=0x669, index=0,
-                                 data=[int(bool(enabled))])
-        self._send(tel)
+        self._set_session(0x669, 0, [int(bool(enabled))])
 
     def zero(self, axis):
         tel = self._set_telegram(address=0x60d, index=int(axis), data=[1])
         self._send(tel)
 
     def zero_all(self):
-        for axis in range(3):
-            self.zero(axis)
+        self.transact([self._set_telegram(address=0x60d, index=axis,
+                                          data=[1])
+                       for axis in range(3)], wait=False)
+
+    def transact(self, telegrams, timeout=2.0, wait=True):
+        '''Send telegrams in one write and collect all their ACKs
+
+        Parameters
+        ----------
+        telegrams : sequence
+            Get/Set telegrams, e.g. from _get_telegram/_set_telegram
+        timeout : float, optional
+            Seconds to wait for all acknowledgements
+        wait : bool, optional
+            Return immediately after sending; otherwise the receive thread
+            is started if it is not running
+
+        Returns
+        -------
+        acks : list of (reason, data)
+            One per telegram, in order
+
+        Raises
+        ------
+        TelegramError
+            If not all telegrams were acknowledged in time
+        '''
+        batch = _Batch(telegrams)
+        if not batch.telegrams:
+            return []
+
+        if wait:
+            # acknowledgements are delivered by the receive thread
+            self.run()
+            for position, tel in enumerate(batch.telegrams):
+                with self._req_lock:
+                    self._waiters[tel.sequence_num] = (batch, position)
+                self._track(tel)
+
+        self._send_all(batch.telegrams)
+        if not wait:
+            return None
+
+        if not batch.done.wait(timeout):
+            with self._req_lock:
+                for tel in batch.telegrams:
+                    self._waiters.pop(tel.sequence_num, None)
+                    self._requests.pop(tel.sequence_num, None)
+            raise TelegramError('{} of {} telegrams unacknowledged after '
+                                '{}s'.format(batch.remaining,
+                                             len(batch.telegrams), timeout))
+        return batch.acks
+
+    @staticmethod
+    def _register_key(register):
+        if isinstance(register, tuple):
+            return register
+        return (register, 0)
+
+    def _check_acks(self, registers, acks):
+        for (address, index), (reason, data) in zip(registers, acks):
+            if reason != REASON_OK:
+                raise TelegramError('Register 0x{:x}:{:d}: {}'.format(
+                    address, index, reason_strings.get(reason, reason)))
+
+    def read_registers(self, registers, timeout=2.0):
+        '''Read many registers in a single round trip
+
+        Parameters
+        ----------
+        registers : sequence of int or (address, index)
+
+        Returns
+        -------
+        values : list of list of int
+            The data words of each register, in order
+        '''
+        registers = [self._register_key(reg) for reg in registers]
+        acks = self.transact([self._get_telegram(address=address,
+                                                 index=index)
+                              for address, index in registers],
+                             timeout=timeout)
+        self._check_acks(registers, acks)
+        return [data for reason, data in acks]
+
+    def write_registers(self, values, timeout=2.0):
+        '''Write many registers in a single round trip
+
+        Parameters
+        ----------
+        values : dict or sequence of ((address, index), data)
+            data is a list of data words, or a single int
+        '''
+        if isinstance(values, dict):
+            values = values.items()
+
+        registers, telegrams = [], []
+        for register, data in values:
+            address, index = self._register_key(register)
+            if isinstance(data, int):
+                data = [data]
+            registers.append((address, index))
+            telegrams.append(self._set_telegram(address=address,
+                                                index=index, data=data))
+
+        self._check_acks(registers, self.transact(telegrams,
+                                                  timeout=timeout))
@@ -47,7 +47,7 @@ reason_strings = {
     REASON_IGNORED: 'telegram was ignored',
     REASON_VERIFY: 'verification of data failed',
     REASON_TYPE: 'wrong data type',
-    REASON_UNKNW: 'unknown error',
+    REASON_UNKNOWN: 'unknown error',
 }
 
 # Maximum number of axes
@@ -82,6 +82,23 @@ ID_FPS_SYNC_POS = 0x692
 
 ID_FPS_TELL_OFF = 0x145  # idx = 0 (what does this do?)
 
+# Sample time
+#
+# Single Int32 in units of 10.24 us (1 ms = 97.65625 units)
+ID_FPS_SAMPLE_TIME = 0x68e
+
+
+def decode_sync_positions(lower, upper):
+    '''Combine ID_FPS_SYNC_POS data words into signed 48-bit positions [pm]
+
+    Works element-wise on numpy arrays of the lower 32-bit and upper 16-bit
+    words.
+    '''
+    lower = np.asarray(lower, dtype=np.int64) & 0xffffffff
+    upper = np.asarray(upper, dtype=np.int64) & 0xffff
+    pm = (upper << 32) | lower
+    return np.where(pm >= (1 << 47), pm - (1 << 48), pm)
+
 
 class UcTelegram(ctypes.Structure):
     _fields_ = [('length', c_int32),
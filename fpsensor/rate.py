@@ -0,0 +1,138 @@
+'''Sample-rate verification and auto-tuning shared by both backends
+
+Sample periods are in milliseconds, as in FPSDevice.monitor.
+'''
+import collections
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Device clock tick of both the sample-time register and the userlib
+TIME_SCALE_MS = 1.024e-2
+
+RateReport = collections.namedtuple(
+    'RateReport', 'nominal measured samples gaps drop_rate')
+RateReport.__doc__ = '''Result of measure_rate
+
+nominal : float
+    Configured sample period [ms]
+measured : float
+    Period of the delivered stream, by its timestamps [ms]
+samples : int
+    Samples delivered during the measurement
+gaps : int
+    Gaps (missed sequences, outages) marked during the measurement
+drop_rate : float
+    Fraction of the samples nominally expected over the timestamp span of
+    the delivered stream that did not arrive
+'''
+
+
+def to_ticks(period_ms):
+    '''Sample period [ms] in device clock ticks'''
+    return int(round(float(period_ms) / TIME_SCALE_MS))
+
+
+def measure_rate(store, duration, nominal=None):
+    '''Measure the stream delivered into a SampleStore
+
+    Parameters
+    ----------
+    store : SampleStore
+    duration : float
+        Seconds to measure for
+    nominal : float, optional
+        Configured sample period [ms], for the drop rate
+
+    Returns
+    -------
+    report : RateReport
+
+    Rates are taken over the timestamps of the samples delivered rather
+    than over the measurement time, which would count whole batches in or
+    out depending on where they land.
+    '''
+    lock = threading.Lock()
+    counts = {'samples': 0, 'gaps': 0, 'first': None, 'last': None}
+
+    def on_samples(timestamps, values):
+        if not len(timestamps):
+            return
+        with lock:
+            counts['samples'] += len(timestamps)
+            if counts['first'] is None:
+                counts['first'] = timestamps[0]
+            counts['last'] = timestamps[-1]
+
+    def on_gap(gap):
+        with lock:
+            counts['gaps'] += 1
+
+    store.subscribe(on_samples)
+    store.subscribe_gaps(on_gap)
+    t0 = time.monotonic()
+    try:
+        time.sleep(duration)
+    finally:
+        store.unsubscribe(on_samples)
+        store.unsubscribe_gaps(on_gap)
+    elapsed = time.monotonic() - t0
+
+    samples = counts['samples']
+    if samples > 1:
+        span = float(counts['last'] - counts['first']) * 1e3
+        measured = span / (samples - 1)
+    else:
+        span = elapsed * 1e3
+        measured = float('inf')
+
+    drop_rate = 0.0
+    if nominal:
+        # samples delivered within the span, and those missed in gaps
+        expected = max(span / nominal + 1, 1.0)
+        drop_rate = min(1.0, max(0.0, 1.0 - samples / expected))
+    return RateReport(nominal, measured, samples, counts['gaps'], drop_rate)
+
+
+def auto_tune(probe, min_period, max_period, max_drop=0.02):
+    '''Find the shortest sample period the pipeline sustains
+
+    Binary search over device clock ticks between min_period and max_period
+    [ms], assuming that a period which is sustained leaves longer ones
+    sustained too.
+
+    Parameters
+    ----------
+    probe : callable
+        probe(period) applies a sample period [ms] and returns a RateReport
+    max_drop : float, optional
+        Highest acceptable drop rate; any gap fails a probe
+
+    Returns
+    -------
+    report : RateReport or None
+        Report of the fastest sustained period, None if even max_period
+        failed
+    '''
+    def sustained(report):
+        return report.gaps == 0 and report.drop_rate <= max_drop
+
+    lo, hi = max(1, to_ticks(min_period)), max(1, to_ticks(max_period))
+    best = None
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        report = probe(mid * TIME_SCALE_MS)
+        logger.debug('Auto-tune probe %s', report)
+        if sustained(report):
+            best = report
+            hi = mid - 1
+        else:
+            lo = mid + 1
+
+    if best is not None:
+        # leave the fastest sustained period applied
+        probe(best.nominal)
+    return best
@@ -0,0 +1,182 @@
+'''Deterministic replay of recorded sessions through the live ingestion paths
+
+Captures saved with np.save by the test scripts, a (4, n) array of
+timestamps [s] and the three axis positions [um], or raw telegram logs
+(FPSensor.start_capture) are fed through the same code that handles live
+data, so the store, its subscribers and anything attached to them see
+exactly what they would during acquisition::
+
+    dev = FPSDevice(None, 0, 'replay', 0, False)
+    report = ReplaySource('test.npy', speed=10.0).run(dev)
+    print(report)
+
+speed=1.0 reproduces the original pace, speed=N plays N times faster and
+speed=None as fast as possible.  The report gives the consumer throughput
+and, when paced, the lag behind schedule and where it first exceeded the
+tolerance.
+'''
+import collections
+import time
+import numpy as np
+
+from ctypes import (c_int32, sizeof)
+
+from .proto import (capture, telegram)
+from .proto.fpsensor import FPSensor
+from .userlib.device import FPSDevice
+
+
+ReplayReport = collections.namedtuple(
+    'ReplayReport',
+    'samples elapsed throughput max_lag behind_index behind_time')
+
+
+def load_capture(filename):
+    '''Load a capture as (timestamps, values)
+
+    Either a (4, n) np.save array or a raw telegram log written by
+    FPSensor.start_capture, from which the received SYNC_POS positions are
+    taken.
+
+    Returns
+    -------
+    timestamps : np.ndarray, shape (n, )
+    values : np.ndarray, shape (3, n)
+    '''
+    with open(filename, 'rb') as f:
+        is_telegram_log = (f.read(len(capture.MAGIC)) == capture.MAGIC)
+
+    if is_telegram_log:
+        return capture.capture_positions(capture.read_capture(filename))
+
+    data = np.load(filename)
+    if data.ndim != 2 or data.shape[0] != 4:
+        raise ValueError('Expected a (4, n) capture, got shape {}'
+                         ''.format(data.shape))
+
+    # the TCP scripts save a zero-initialized buffer that may not be full
+    valid = data[0, :] > 0
+    if valid.any():
+        data = data[:, np.argmax(valid):]
+    return data[0, :], data[1:, :]
+
+
+def sync_pos_telegram(positions, sequence_num=0):
+    '''Build the ID_FPS_SYNC_POS acknowledgement for positions in um'''
+    tel = telegram.UcAckTelegram(6)()
+    tel.length = sizeof(tel) - sizeof(c_int32)
+    tel.opcode = telegram.ACK
+    tel.address = telegram.ID_FPS_SYNC_POS
+    tel.sequence_num = sequence_num
+    tel.reason = telegram.REASON_OK
+    for i, pos in enumerate(positions):
+        # 48-bit picometres, split into lower 32 and upper 16 bits
+        pm = int(round(pos * 1e6)) & 0xffffffffffff
+        lower = pm & 0xffffffff
+        tel.data[2 * i] = lower - (1 << 32) if lower >= (1 << 31) else lower
+        tel.data[2 * i + 1] = pm >> 32
+    return tel
+
+
+class ReplaySource(object):
+    '''Replays a capture into an FPSDevice or TCP FPSensor
+
+    Parameters
+    ----------
+    source : str or (timestamps, values)
+        Capture filename, or the arrays themselves
+    speed : float or None, optional
+        Playback speed relative to the original pace; None for as fast as
+        possible
+    batch_size : int, optional
+        Samples per position callback when replaying into an FPSDevice
+    tolerance : float, optional
+        Lag [s] behind schedule at which the consumer counts as falling
+        behind
+    '''
+    def __init__(self, source, speed=1.0, batch_size=100, tolerance=0.05):
+        if isinstance(source, str):
+            self.timestamps, self.values = load_capture(source)
+        else:
+            self.timestamps, self.values = (np.asarray(arr)
+                                            for arr in source)
+
+        self.speed = speed
+        self.batch_size = int(batch_size)
+        self.tolerance = tolerance
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _batches(self, batch_size):
+        for start in range(0, len(self), batch_size):
+            yield start, min(start + batch_size, len(self))
+
+    def _paced(self, batch_size, deliver):
+        '''Call deliver(start, stop) per batch on schedule; return a report'''
+        t0 = time.monotonic()
+        rel = (self.timestamps - self.timestamps[0]).tolist()
+        max_lag = 0.0
+        behind_index = behind_time = None
+
+        for start, stop in self._batches(batch_size):
+            if self.speed is not None:
+                # a batch is due once its last sample would have arrived
+                due = t0 + rel[stop - 1] / self.speed
+                lag = time.monotonic() - due
+                if lag < 0:
+                    time.sleep(-lag)
+                    lag = 0.0
+                elif lag > max_lag:
+                    max_lag = lag
+                if lag > self.tolerance and behind_index is None:
+                    behind_index = start
+                    behind_time = self.timestamps[start]
+
+            deliver(start, stop)
+
+        elapsed = time.monotonic() - t0
+        throughput = len(self) / elapsed if elapsed > 0 else float('inf')
+        return ReplayReport(len(self), elapsed, throughput, max_lag,
+                            behind_index, behind_time)
+
+    def replay_device(self, device):
+        '''Feed batches through FPSDevice._monitor, as the callback would'''
+        period = float(np.median(np.diff(self.timestamps))) \
+            if len(self) > 1 else 1e-3
+
+        device._reset()
+        device._time_base = None
+        device._sample_rate = (period * 1e3) / device._TIME_SCALE_MS
+        device._reset_clock()
+        device._monitoring = True
+
+        def deliver(start, stop):
+            # only real-time playback has arrival times to correlate
+            host_time = time.monotonic() if self.speed == 1.0 else None
+            device._monitor(stop - start, start, self.values[:, start:stop],
+                            host_time)
+
+        try:
+            return self._paced(self.batch_size, deliver)
+        finally:
+            device._monitoring = False
+
+    def replay_tcp(self, fps):
+        '''Feed SYNC_POS acknowledgements through FPSensor._check_response'''
+        telegrams = [sync_pos_telegram(self.values[:, i], i % 10000)
+                     for i in range(len(self))]
+
+        def deliver(start, stop):
+            for tel in telegrams[start:stop]:
+                fps._check_response(tel)
+
+        return self._paced(1, deliver)
+
+    def run(self, target):
+        '''Replay into target, an FPSDevice or a TCP FPSensor'''
+        if isinstance(target, FPSDevice):
+            return self.replay_device(target)
+        elif isinstance(target, FPSensor):
+            return self.replay_tcp(target)
+        raise TypeError('Cannot replay into {!r}'.format(target))
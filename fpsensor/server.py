@@ -0,0 +1,343 @@
+'''Republish a live sample stream to many local subscribers
+
+Only one client can own an FPS3010 at a time.  StreamServer takes the
+stream of a SampleStore (either backend) and rebroadcasts it as batched
+binary frames over TCP; StreamClient receives them into a local
+SampleStore, so that subscribers use the same stream interfaces as the
+acquisition process::
+
+    server = fps.serve(port=5010)
+
+    client = StreamClient('acq-host', 5010, decimation=10)
+    client.store.subscribe(callback)
+
+Protocol: the subscriber sends a request (magic, decimation).  The server
+then sends frames, each a header (magic, kind, sequence, sample count,
+channels, value dtype) followed by the float64 timestamps and the
+(channels, n) values.  Gap frames carry no samples but the start and end
+of the gap as their two timestamps.
+'''
+import collections
+import logging
+import socket
+import struct
+import threading
+import numpy as np
+
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+from .stream import SampleStore
+
+
+logger = logging.getLogger(__name__)
+
+REQUEST = struct.Struct('<4sI')
+REQUEST_MAGIC = b'FPSR'
+FRAME = struct.Struct('<4sBQII2s')
+FRAME_MAGIC = b'FPSF'
+
+FRAME_SAMPLES = 0
+FRAME_GAP = 1
+
+
+def encode_frame(sequence, timestamps, values, kind=FRAME_SAMPLES):
+    '''Encode a batch as one frame'''
+    timestamps = np.ascontiguousarray(timestamps, dtype='<f8')
+    values = np.ascontiguousarray(values)
+    values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+    dtype = values.dtype.str[1:].encode('ascii')[:2]
+    channels = values.shape[0] if values.ndim == 2 else 0
+    header = FRAME.pack(FRAME_MAGIC, kind, sequence, len(timestamps),
+                        channels, dtype)
+    return b''.join((header, timestamps.tobytes(), values.tobytes()))
+
+
+def _recv_exact(sock, nbytes):
+    buf = bytearray(nbytes)
+    view = memoryview(buf)
+    got = 0
+    while got < nbytes:
+        received = sock.recv_into(view[got:], nbytes - got)
+        if received == 0:
+            raise EOFError('connection closed')
+        got += received
+    return buf
+
+
+def read_frame(sock):
+    '''Read one frame from a socket
+
+    Returns
+    -------
+    kind : int
+    sequence : int
+    timestamps : np.ndarray, shape (n, )
+    values : np.ndarray, shape (channels, n)
+    '''
+    magic, kind, sequence, num, channels, dtype = FRAME.unpack(
+        _recv_exact(sock, FRAME.size))
+    if magic != FRAME_MAGIC:
+        raise ValueError('Bad frame magic: {!r}'.format(magic))
+
+    if kind == FRAME_GAP:
+        timestamps = np.frombuffer(_recv_exact(sock, 16), dtype='<f8')
+        return kind, sequence, timestamps, None
+
+    dtype = np.dtype('<' + dtype.decode('ascii'))
+    timestamps = np.frombuffer(_recv_exact(sock, 8 * num), dtype='<f8')
+    values = np.frombuffer(_recv_exact(sock, dtype.itemsize * channels * num),
+                           dtype=dtype).reshape(channels, num)
+    return kind, sequence, timestamps, values
+
+
+class _Subscriber(object):
+    def __init__(self, sock, addr, decimation, max_queue):
+        self.sock = sock
+        self.addr = addr
+        self.decimation = max(1, decimation)
+        self.dropped = 0
+        self.queue = Queue.Queue(maxsize=max_queue)
+        self.thread = None
+
+    def __str__(self):
+        return '<Subscriber addr={0.addr} decimation={0.decimation} ' \
+               'dropped={0.dropped}>'.format(self)
+
+    def put(self, frame):
+        try:
+            self.queue.put_nowait(frame)
+        except Queue.Full:
+            self.dropped += 1
+
+
+class StreamServer(object):
+    '''Serve the batches of a SampleStore to TCP subscribers
+
+    Frames are encoded once per batch and decimation factor, in the thread
+    appending to the store, then sent by one thread per subscriber.
+    A subscriber that cannot keep up has frames dropped rather than
+    holding back acquisition.
+
+    Parameters
+    ----------
+    store : SampleStore
+    host : str, optional
+        Address to listen on
+    port : int, optional
+        Port to listen on; 0 picks a free one
+    max_queue : int, optional
+        Frames queued per subscriber before dropping
+    '''
+    def __init__(self, store, host='', port=0, max_queue=256):
+        self._store = store
+        self._max_queue = max_queue
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._running = True
+        # per decimation factor: frame sequence number and sample phase
+        self._sequences = collections.defaultdict(int)
+        self._phases = collections.defaultdict(int)
+
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(8)
+        self._address = self._listener.getsockname()
+
+        self._thread = threading.Thread(target=self._accept_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+        store.subscribe(self._publish)
+        store.subscribe_gaps(self._publish_gap)
+
+    def __str__(self):
+        return '<StreamServer address={0.address} subscribers={1}>'.format(
+            self, len(self._subscribers))
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def subscribers(self):
+        with self._lock:
+            return list(self._subscribers)
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                sock, addr = self._listener.accept()
+            except socket.error:
+                break
+
+            try:
+                sock.settimeout(2.0)
+                magic, decimation = REQUEST.unpack(
+                    _recv_exact(sock, REQUEST.size))
+                if magic != REQUEST_MAGIC:
+                    raise ValueError('Bad request magic: {!r}'.format(magic))
+                sock.settimeout(None)
+            except Exception as ex:
+                logger.warning('Rejected subscriber %s: %s', addr, ex)
+                sock.close()
+                continue
+
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sub = _Subscriber(sock, addr, decimation, self._max_queue)
+            sub.thread = threading.Thread(target=self._send_loop,
+                                          args=(sub, ))
+            sub.thread.daemon = True
+            with self._lock:
+                self._subscribers.append(sub)
+            sub.thread.start()
+            logger.info('New subscriber %s', sub)
+
+    def _send_loop(self, sub):
+        try:
+            while self._running:
+                frame = sub.queue.get()
+                if frame is None:
+                    break
+                sub.sock.sendall(frame)
+        except socket.error as ex:
+            logger.info('Subscriber %s disconnected: %s', sub, ex)
+        finally:
+            with self._lock:
+                if sub in self._subscribers:
+                    self._subscribers.remove(sub)
+            sub.sock.close()
+
+    def _publish(self, timestamps, values):
+        frames = {}
+        for sub in self.subscribers:
+            step = sub.decimation
+            if step not in frames:
+                frames[step] = self._encode(step, timestamps, values)
+            if frames[step] is not None:
+                sub.put(frames[step])
+
+    def _encode(self, step, timestamps, values):
+        if step > 1:
+            phase = self._phases[step]
+            idx = np.arange((step - phase) % step, len(timestamps), step)
+            self._phases[step] = (phase + len(timestamps)) % step
+            if len(idx) == 0:
+                return None
+            timestamps, values = timestamps[idx], values[:, idx]
+
+        sequence = self._sequences[step]
+        self._sequences[step] += 1
+        return encode_frame(sequence, timestamps, values)
+
+    def _publish_gap(self, gap):
+        frames = {}
+        for sub in self.subscribers:
+            step = sub.decimation
+            if step not in frames:
+                sequence = self._sequences[step]
+                self._sequences[step] += 1
+                frames[step] = encode_frame(sequence, [gap.start, gap.end],
+                                            [], kind=FRAME_GAP)
+            sub.put(frames[step])
+
+    def close(self):
+        self._running = False
+        self._store.unsubscribe(self._publish)
+        self._store.unsubscribe_gaps(self._publish_gap)
+        try:
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._listener.close()
+        self._thread.join()
+
+        for sub in self.subscribers:
+            try:
+                sub.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sub.put(None)
+
+
+class StreamClient(object):
+    '''Subscribe to a StreamServer, feeding a local SampleStore
+
+    Parameters
+    ----------
+    host : str
+    port : int
+    decimation : int, optional
+        Keep only every decimation-th sample
+    buffer_size : int, optional
+        Capacity of the local store
+    channels : int, optional
+        Number of value channels of the served stream
+    '''
+    def __init__(self, host, port, decimation=1, buffer_size=2 ** 20,
+                 channels=3):
+        self._host = host
+        self._port = port
+        self._decimation = int(decimation)
+        self._store = SampleStore(buffer_size, channels=channels)
+        self._sock = None
+        self._thread = None
+        self._running = False
+        self.missed_frames = 0
+
+    def __str__(self):
+        return '<StreamClient host={0._host} port={0._port} ' \
+               'decimation={0._decimation}>'.format(self)
+
+    @property
+    def store(self):
+        return self._store
+
+    def _receive_loop(self):
+        expected = None
+        try:
+            while self._running:
+                kind, sequence, timestamps, values = read_frame(self._sock)
+                if expected is not None and sequence != expected:
+                    self.missed_frames += sequence - expected
+                expected = sequence + 1
+
+                if kind == FRAME_GAP:
+                    self._store.mark_gap(timestamps[0], timestamps[1],
+                                         'upstream gap')
+                else:
+                    self._store.append(timestamps, values)
+        except (EOFError, socket.error) as ex:
+            if self._running:
+                logger.warning('Stream from %s:%d ended: %s', self._host,
+                               self._port, ex)
+        finally:
+            self._running = False
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._sock = socket.create_connection((self._host, self._port))
+        self._sock.sendall(REQUEST.pack(REQUEST_MAGIC, self._decimation))
+        self._running = True
+        self._thread = threading.Thread(target=self._receive_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._sock.close()
+            self._sock = None
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,233 @@
+'''Shared-memory export of live sample stores
+
+The acquisition process publishes a SampleStore::
+
+    writer = fps.share('fps-live')
+
+and any other process attaches by name::
+
+    reader = SharedRingReader('fps-live')
+    for timestamps, values in reader.read_new():
+        ...
+
+The segment starts with a small header (sequence counter, write count,
+capacity, channels and value dtype), followed by the timestamp ring and the
+(channels, capacity) value ring.  The sequence counter is odd while a batch
+is being written.
+'''
+import logging
+import numpy as np
+
+from multiprocessing import shared_memory
+
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = 0x46505331  # 'FPS1'
+_HEADER = np.dtype([('magic', '<i8'),
+                    ('sequence', '<i8'),
+                    ('count', '<i8'),
+                    ('capacity', '<i8'),
+                    ('channels', '<i8'),
+                    ('dtype', 'S16'),
+                    ])
+
+
+def _layout(buf, capacity, channels, dtype):
+    header = np.ndarray((1, ), dtype=_HEADER, buffer=buf)[0]
+    offset = _HEADER.itemsize
+    times = np.ndarray((capacity, ), dtype=np.float64, buffer=buf,
+                       offset=offset)
+    offset += times.nbytes
+    values = np.ndarray((channels, capacity), dtype=dtype, buffer=buf,
+                        offset=offset)
+    return header, times, values
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+
+    # before Python 3.13 every attaching process registers the segment with
+    # its resource tracker, which would unlink it when the reader exits
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedRingWriter(object):
+    '''Mirror a SampleStore into a shared-memory ring
+
+    Parameters
+    ----------
+    store : SampleStore
+    name : str, optional
+        Name of the shared-memory segment; generated if not given
+    capacity : int, optional
+        Ring size in samples, defaults to the store capacity
+    '''
+    def __init__(self, store, name=None, capacity=None):
+        if capacity is None:
+            capacity = store.capacity
+
+        self._store = store
+        self._capacity = int(capacity)
+        self._channels = store.channels
+        dtype = store.dtype
+
+        size = (_HEADER.itemsize + 8 * self._capacity +
+                dtype.itemsize * self._channels * self._capacity)
+        self._shm = shared_memory.SharedMemory(name=name, create=True,
+                                               size=size)
+        self._header, self._times, self._values = _layout(
+            self._shm.buf, self._capacity, self._channels, dtype)
+
+        self._header['magic'] = _MAGIC
+        self._header['sequence'] = 0
+        self._header['count'] = 0
+        self._header['capacity'] = self._capacity
+        self._header['channels'] = self._channels
+        self._header['dtype'] = dtype.str.encode('ascii')
+
+        self._write(*store.latest(self._capacity))
+        store.subscribe(self._write)
+
+    def __str__(self):
+        return '<SharedRingWriter name={0.name} capacity={0._capacity} ' \
+               'count={1}>'.format(self, self.count)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def count(self):
+        return int(self._header['count'])
+
+    def _write(self, timestamps, values):
+        n = len(timestamps)
+        if n == 0:
+            return
+
+        skip = max(0, n - self._capacity)
+        count = int(self._header['count'])
+        start = (count + skip) % self._capacity
+        first = min(n - skip, self._capacity - start)
+
+        # count is published first, so readers can tell which slots are
+        # being overwritten
+        self._header['sequence'] += 1
+        self._header['count'] = count + n
+        self._times[start:start + first] = timestamps[skip:skip + first]
+        self._values[:, start:start + first] = values[:, skip:skip + first]
+        if skip + first < n:
+            rest = n - skip - first
+            self._times[:rest] = timestamps[skip + first:]
+            self._values[:, :rest] = values[:, skip + first:]
+        self._header['sequence'] += 1
+
+    def close(self):
+        '''Stop publishing and remove the segment'''
+        self._store.unsubscribe(self._write)
+        del self._header, self._times, self._values
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class SharedRingReader(object):
+    '''Attach to a ring published by SharedRingWriter
+
+    Parameters
+    ----------
+    name : str
+        Name of the shared-memory segment
+    from_start : bool, optional
+        Return the samples already in the ring on the first read instead of
+        only those written after attaching
+    '''
+    def __init__(self, name, from_start=False):
+        self._shm = _attach(name)
+        header = np.ndarray((1, ), dtype=_HEADER, buffer=self._shm.buf)[0]
+        if header['magic'] != _MAGIC:
+            self._shm.close()
+            raise ValueError('{} is not a sample ring'.format(name))
+
+        self._capacity = int(header['capacity'])
+        self._channels = int(header['channels'])
+        dtype = np.dtype(header['dtype'].decode('ascii'))
+        self._header, self._times, self._values = _layout(
+            self._shm.buf, self._capacity, self._channels, dtype)
+
+        self._read_idx = 0 if from_start else self._stable_count()
+        self._segment_start = self._read_idx
+        self.lost = 0
+
+    def __str__(self):
+        return '<SharedRingReader name={0.name} read={0._read_idx} ' \
+               'lost={0.lost}>'.format(self)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def channels(self):
+        return self._channels
+
+    def _stable_count(self):
+        while True:
+            seq = self._header['sequence']
+            count = int(self._header['count'])
+            if seq % 2 == 0 and seq == self._header['sequence']:
+                return count
+
+    @property
+    def overrun(self):
+        '''The views returned by the last read_new have been overwritten'''
+        count = int(self._header['count'])
+        return count - self._capacity > self._segment_start
+
+    def read_new(self):
+        '''Zero-copy views of the samples written since the last call
+
+        Returns at most two (timestamps, values) pairs, as the new data may
+        wrap around the end of the ring.  The views stay valid until the
+        writer laps them (see overrun).  Samples overwritten before they
+        could be read are counted in lost.
+        '''
+        count = self._stable_count()
+        oldest = max(0, count - self._capacity)
+        if self._read_idx < oldest:
+            self.lost += oldest - self._read_idx
+            self._read_idx = oldest
+
+        start, self._read_idx = self._read_idx, count
+        self._segment_start = start
+        if count == start:
+            return []
+
+        first = start % self._capacity
+        end = first + (count - start)
+        if end <= self._capacity:
+            return [(self._times[first:end], self._values[:, first:end])]
+
+        end -= self._capacity
+        return [(self._times[first:], self._values[:, first:]),
+                (self._times[:end], self._values[:, :end])]
+
+    def close(self):
+        del self._header, self._times, self._values
+        self._shm.close()
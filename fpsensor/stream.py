@@ -0,0 +1,398 @@
+'''Sample storage shared by the TCP and userlib backends
+'''
+import collections
+import logging
+import numpy as np
+
+from .fastpath import FastPath
+
+
+logger = logging.getLogger(__name__)
+
+
+# A break in the sample stream: samples before `index` end at `start`, and
+# acquisition resumed at `end` (timestamps, in the store's time base)
+Gap = collections.namedtuple('Gap', 'index start end reason')
+
+# A consistent copy of stored samples: `first` is the index (counted since
+# the last clear, as Gap.index) of the first sample, and `overrun` is set if
+# requested samples were overwritten before they could be read
+Snapshot = collections.namedtuple('Snapshot',
+                                  'timestamps values first overrun')
+
+
+class SampleStore(object):
+    '''Fixed-capacity ring buffer of timestamped position samples
+
+    Timestamps are kept in a float64 vector and the channel values in a
+    (channels, capacity) array.  Batches are appended with vectorized
+    writes, and every appended batch is handed to the subscribers, which
+    is the stream interface the acquisition classes expose.
+
+    Values can be kept as integer counts (e.g. picometres) and converted to
+    physical units, count * scale, only when read.  With an integer type
+    narrower than int64 the counts are stored as deltas from a per-channel
+    offset (by default the first sample), and out-of-range deltas are
+    clipped and counted in `clipped`.  append() always takes counts; readers
+    and subscribers get physical values unless they ask for raw counts.
+
+    Other threads read with snapshot(), seqlock-style: the writer announces
+    the range it is about to overwrite before touching the arrays, and a
+    reader validates its copy against that afterwards, trimming (and
+    flagging) whatever was overwritten meanwhile.  Neither side ever waits
+    for the other.
+
+    Parameters
+    ----------
+    capacity : int
+        Maximum number of samples kept
+    channels : int, optional
+        Number of value channels (default 3, one per axis)
+    dtype : np.dtype, optional
+        Storage type of the values
+    scale : float, optional
+        Physical units per stored count; None stores physical values
+    offset : array-like, optional
+        Per-channel offset [counts] of narrow integer storage
+    '''
+    _MAX_GAPS = 1000
+    _SNAPSHOT_RETRIES = 3
+
+    def __init__(self, capacity, channels=3, dtype=np.float64, scale=None,
+                 offset=None):
+        self._capacity = int(capacity)
+        self._channels = int(channels)
+        self._times = np.zeros(self._capacity, dtype=np.float64)
+        self._values = np.zeros((self._channels, self._capacity), dtype=dtype)
+        self._scale = scale
+
+        dtype = self._values.dtype
+        self._delta = (dtype.kind in 'iu' and dtype.itemsize < 8)
+        if offset is not None:
+            offset = np.asarray(offset, dtype=np.int64).reshape(-1, 1)
+        self._initial_offset = offset
+        self._offset = offset
+        self.clipped = 0
+        self._count = 0
+        # end of the range being written; samples before
+        # _reserved - capacity are safe to read
+        self._reserved = 0
+        self._generation = 0
+        self._subscribers = []
+        self._raw_subscribers = []
+        self._gap_subscribers = []
+        self.gaps = collections.deque(maxlen=self._MAX_GAPS)
+
+    def __str__(self):
+        return '<SampleStore channels={0._channels} capacity={0._capacity} ' \
+               'count={0._count}>'.format(self)
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def scale(self):
+        '''Physical units per stored count, or None'''
+        return self._scale
+
+    @property
+    def dtype(self):
+        '''Type of the values as read'''
+        if self._scale is not None:
+            return np.dtype(np.float64)
+        return self._values.dtype
+
+    @property
+    def nbytes(self):
+        '''Memory used by the sample arrays'''
+        return self._times.nbytes + self._values.nbytes
+
+    @property
+    def count(self):
+        '''Total number of samples appended since the last clear'''
+        return self._count
+
+    def __len__(self):
+        return min(self._count, self._capacity)
+
+    def clear(self):
+        self._generation += 1
+        self._count = 0
+        self._reserved = 0
+        self._offset = self._initial_offset
+        self.clipped = 0
+        self.gaps.clear()
+
+    def subscribe(self, callback, raw=False):
+        '''Call callback(timestamps, values) for every appended batch
+
+        Values are physical, or the appended counts if raw.
+        '''
+        subscribers = self._raw_subscribers if raw else self._subscribers
+        if callback not in subscribers:
+            subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        for subscribers in (self._subscribers, self._raw_subscribers):
+            try:
+                subscribers.remove(callback)
+            except ValueError:
+                pass
+
+    def to_physical(self, counts):
+        '''Convert counts (e.g. from a raw subscription) to physical units'''
+        if self._scale is None:
+            return np.asarray(counts)
+        return np.multiply(counts, self._scale, dtype=np.float64)
+
+    def _encode(self, values):
+        '''Counts to stored values'''
+        if not self._delta:
+            return values
+
+        if self._offset is None:
+            self._offset = values[:, :1].astype(np.int64)
+        stored = values - self._offset
+        info = np.iinfo(self._values.dtype)
+        outside = (stored < info.min) | (stored > info.max)
+        if outside.any():
+            if not self.clipped:
+                logger.warning('%s: values out of range of %s deltas; '
+                               'clipping', self, self._values.dtype)
+            self.clipped += int(outside.sum())
+            stored = np.clip(stored, info.min, info.max)
+        return stored
+
+    def _decode(self, stored, raw=False):
+        '''Stored values to counts, or to physical values unless raw'''
+        if self._delta:
+            offset = self._offset if self._offset is not None else 0
+            stored = stored.astype(np.int64) + offset
+        if raw or self._scale is None:
+            return stored
+        return np.multiply(stored, self._scale, dtype=np.float64)
+
+    def subscribe_gaps(self, callback):
+        '''Call callback(gap) whenever a Gap is marked'''
+        if callback not in self._gap_subscribers:
+            self._gap_subscribers.append(callback)
+
+    def unsubscribe_gaps(self, callback):
+        try:
+            self._gap_subscribers.remove(callback)
+        except ValueError:
+            pass
+
+    def mark_gap(self, start, end, reason=''):
+        '''Record that no samples were acquired between start and end'''
+        gap = Gap(self._count, start, end, reason)
+        self.gaps.append(gap)
+        for callback in list(self._gap_subscribers):
+            try:
+                callback(gap)
+            except Exception:
+                logger.exception('Gap subscriber %r failed', callback)
+        return gap
+
+    def append(self, timestamps, values):
+        '''Append a batch of samples
+
+        Parameters
+        ----------
+        timestamps : array-like, shape (n, )
+        values : array-like, shape (channels, n)
+        '''
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values)
+        n = len(timestamps)
+        if n == 0:
+            return
+
+        stored = self._encode(values)
+
+        # only the newest samples of an oversized batch can be kept
+        skip = max(0, n - self._capacity)
+        end = self._count + n
+        self._reserved = end
+        start = (self._count + skip) % self._capacity
+        first = min(n - skip, self._capacity - start)
+
+        self._times[start:start + first] = timestamps[skip:skip + first]
+        self._values[:, start:start + first] = stored[:, skip:skip + first]
+        if skip + first < n:
+            rest = n - skip - first
+            self._times[:rest] = timestamps[skip + first:]
+            self._values[:, :rest] = stored[:, skip + first:]
+
+        self._count = end
+
+        for callback in list(self._raw_subscribers):
+            try:
+                callback(timestamps, values)
+            except Exception:
+                logger.exception('Sample subscriber %r failed', callback)
+
+        if self._subscribers:
+            values = self.to_physical(values)
+            for callback in list(self._subscribers):
+                try:
+                    callback(timestamps, values)
+                except Exception:
+                    logger.exception('Sample subscriber %r failed', callback)
+
+    def _copy(self, arr, first, last):
+        '''Copy of the samples [first, last) of arr, oldest first'''
+        start = first % self._capacity
+        end = start + max(0, last - first)
+        if end <= self._capacity:
+            return arr[..., start:end].copy()
+        return np.concatenate((arr[..., start:],
+                               arr[..., :end - self._capacity]), axis=-1)
+
+    def _search(self, first, last, timestamp, side):
+        '''Index of timestamp in the (ascending) samples [first, last)'''
+        start = first % self._capacity
+        num = last - first
+        head = self._times[start:min(start + num, self._capacity)]
+        if len(head) == num or len(head) == 0:
+            return first + int(np.searchsorted(head, timestamp, side))
+
+        if side == 'left':
+            in_tail = timestamp > head[-1]
+        else:
+            in_tail = timestamp >= head[-1]
+
+        if not in_tail:
+            return first + int(np.searchsorted(head, timestamp, side))
+        tail = self._times[:num - len(head)]
+        return (first + len(head) +
+                int(np.searchsorted(tail, timestamp, side)))
+
+    def snapshot(self, start=None, stop=None, since=None, num=None,
+                 raw=False):
+        '''Consistent copy of the stored samples, without blocking the writer
+
+        Only the selected samples are copied.  Time range selection assumes
+        ascending timestamps.
+
+        Parameters
+        ----------
+        start, stop : float, optional
+            Time range to return, inclusive
+        since : int, optional
+            Return samples from this index on, e.g. the previous snapshot's
+            first + len(timestamps) to read incrementally
+        num : int, optional
+            Return at most the newest num of the selected samples
+        raw : bool, optional
+            Return counts rather than physical values
+
+        Returns
+        -------
+        snapshot : Snapshot
+        '''
+        for attempt in range(self._SNAPSHOT_RETRIES):
+            generation = self._generation
+            last = self._count
+            first = max(0, last - self._capacity)
+            overrun = False
+            if since is not None:
+                overrun = since < first
+                first = min(max(since, first), last)
+            if start is not None:
+                first = self._search(first, last, start, 'left')
+            if stop is not None:
+                last = max(first, self._search(first, last, stop, 'right'))
+            if num is not None:
+                first = max(first, last - num)
+
+            timestamps = self._copy(self._times, first, last)
+            values = self._copy(self._values, first, last)
+            offset = self._offset
+
+            if generation != self._generation or offset is not self._offset:
+                # cleared while reading
+                continue
+
+            valid = self._reserved - self._capacity
+            if first < valid:
+                # the oldest samples were overwritten while being copied
+                overrun = True
+                trim = min(valid, last) - first
+                timestamps, values = timestamps[trim:], values[:, trim:]
+                first += trim
+            return Snapshot(timestamps, self._decode(values, raw=raw), first,
+                            overrun)
+
+        return Snapshot(self._times[:0].copy(),
+                        self._decode(self._values[:, :0], raw=raw), 0, True)
+
+    def latest(self, num=None, raw=False):
+        '''The newest samples, oldest first
+
+        Returns
+        -------
+        timestamps : np.ndarray, shape (n, )
+        values : np.ndarray, shape (channels, n)
+        '''
+        snap = self.snapshot(num=num, raw=raw)
+        return snap.timestamps, snap.values
+
+    @property
+    def data(self):
+        '''All stored samples as one (1 + channels, n) array
+
+        Row 0 holds the timestamps, the remaining rows one channel each.
+        '''
+        timestamps, values = self.latest()
+        data = np.zeros((1 + self._channels, len(timestamps)))
+        data[0, :] = timestamps
+        data[1:, :] = values
+        return data
+
+
+class StreamSource(object):
+    '''Consumers of the store of an acquisition class
+
+    Mixin of the backends, which keep their SampleStore in _store and the
+    list of FastPaths called by their acquisition thread in _fast_paths.
+    '''
+    def share(self, name=None, capacity=None):
+        '''Publish the store in shared memory, see fpsensor.shm'''
+        from .shm import SharedRingWriter
+        return SharedRingWriter(self._store, name=name, capacity=capacity)
+
+    def serve(self, host='', port=0):
+        '''Republish the store to network subscribers, see fpsensor.server'''
+        from .server import StreamServer
+        return StreamServer(self._store, host=host, port=port)
+
+    def trigger(self, conditions, **kwargs):
+        '''Capture triggered event records, see fpsensor.trigger'''
+        from .trigger import Trigger
+        return Trigger(self._store, conditions, **kwargs)
+
+    def derive(self, quantities, compensation=None, **kwargs):
+        '''Publish derived quantities as a store, see fpsensor.derived'''
+        from .derived import DerivedStage
+        return DerivedStage(self._store, quantities,
+                            compensation=compensation, **kwargs)
+
+    def add_fast_path(self, callback, budget=1e-3, on_overrun=None):
+        '''Call callback(timestamps, values) in the acquisition thread
+
+        See fpsensor.fastpath.  Returns the FastPath, which holds the
+        latency statistics.
+        '''
+        fast = FastPath(callback, budget=budget, on_overrun=on_overrun)
+        # copied, so the acquisition thread iterates without a lock
+        self._fast_paths = self._fast_paths + [fast]
+        return fast
+
+    def remove_fast_path(self, fast):
+        self._fast_paths = [fp for fp in self._fast_paths if fp is not fast]
@@ -0,0 +1,202 @@
+'''Correlation of sample indices with the host clock
+
+Neither backend timestamps samples on the device: the userlib delivers a
+device sequence index with every batch, and the TCP protocol only the ACK
+to a polled request.  Stamping samples with the host time at which they
+arrive adds network, queue and thread-scheduling jitter; accumulating a
+nominal period drifts away from real time.
+
+ClockCorrelator fits host_time = offset + period * index online, over a
+window of recent (index, arrival time) observations, rejecting late
+outliers.  Arrivals are only ever delayed, so the offset is aligned to the
+lower envelope of the observations: timestamps carry the minimum transport
+latency as a constant, without its jitter.  Updates come from a single
+thread; the fit is published as one tuple, so that other threads convert
+indices with a consistent fit::
+
+    clock = ClockCorrelator(period=1e-3)
+    clock.update(seq_idx + count - 1, time.monotonic())
+    timestamps = clock.to_host(seq_idx + np.arange(count))
+'''
+import logging
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class ClockCorrelator(object):
+    '''Online robust linear fit of host time against a sample index
+
+    Parameters
+    ----------
+    period : float, optional
+        Nominal seconds per index, used until enough observations are
+        available and as the reference for drift
+    window : int, optional
+        Number of most recent observations fitted
+    min_points : int, optional
+        Observations required before the period is fitted
+    threshold : float, optional
+        Observations further than this many (MAD-estimated) standard
+        deviations from the fit are rejected
+    max_step : float, optional
+        An observation this many seconds off the current fit is taken as a
+        discontinuity (e.g. a restarted device) and restarts the fit
+    refit_every : int, optional
+        Refit the period every this many observations; in between, only the
+        offset follows new observations below the fit
+    '''
+    _MAD_SCALE = 1.4826
+
+    def __init__(self, period=None, window=256, min_points=8, threshold=3.0,
+                 max_step=1.0, refit_every=8):
+        self._nominal = period
+        self._window = int(window)
+        self._min_points = max(2, int(min_points))
+        self._threshold = threshold
+        self._max_step = max_step
+        self._refit_every = max(1, int(refit_every))
+        self.resets = 0
+        self.reset()
+
+    def __str__(self):
+        return '<ClockCorrelator period={0.period} drift={0.drift} ' \
+               'jitter={0.jitter} count={0.count}>'.format(self)
+
+    def reset(self):
+        '''Discard all observations'''
+        self._x = np.zeros(self._window)
+        self._y = np.zeros(self._window)
+        self._count = 0
+        # observations are kept relative to the first one, for precision
+        self._origin = None
+        self._slope = self._nominal
+        self._offset = None
+        self._jitter = None
+        self._fit_state = None
+
+    def _publish(self):
+        self._fit_state = (self._origin[0], self._origin[1], self._offset,
+                           self._slope)
+
+    @property
+    def count(self):
+        '''Observations since the last reset'''
+        return self._count
+
+    @property
+    def nominal_period(self):
+        return self._nominal
+
+    @property
+    def period(self):
+        '''Fitted seconds per index'''
+        return self._slope
+
+    @property
+    def drift(self):
+        '''Relative deviation of the fitted from the nominal period'''
+        if self._slope is None or not self._nominal:
+            return None
+        return self._slope / self._nominal - 1.0
+
+    @property
+    def jitter(self):
+        '''Standard deviation of the accepted arrival times about the fit'''
+        return self._jitter
+
+    @property
+    def fit(self):
+        '''(origin_index, origin_time, offset, slope) or None before a fit
+
+        Read once and passed to to_host, it converts several sets of indices
+        with the same fit while another thread updates the correlator.
+        '''
+        return self._fit_state
+
+    @property
+    def ready(self):
+        '''Indices can be converted'''
+        return self._fit_state is not None
+
+    def update(self, index, host_time):
+        '''Add the observation that index arrived at host_time'''
+        if self._origin is None:
+            self._origin = (index, host_time)
+
+        x = float(index - self._origin[0])
+        y = float(host_time - self._origin[1])
+        if self.ready:
+            residual = y - (self._offset + self._slope * x)
+            if abs(residual) > self._max_step:
+                logger.info('Clock discontinuity of %.3fs; restarting fit',
+                            residual)
+                self.resets += 1
+                self.reset()
+                return self.update(index, host_time)
+
+        pos = self._count % self._window
+        self._x[pos] = x
+        self._y[pos] = y
+        self._count += 1
+        if (self._count <= self._min_points or
+                self._count % self._refit_every == 0 or not self.ready):
+            self._fit()
+        else:
+            self._offset = min(self._offset, y - self._slope * x)
+            self._publish()
+
+    def _fit(self):
+        num = min(self._count, self._window)
+        x, y = self._x[:num], self._y[:num]
+
+        slope = self._slope
+        keep = np.ones(num, dtype=bool)
+        if num >= self._min_points and np.ptp(x) > 0:
+            for _ in range(3):
+                xk, yk = x[keep], y[keep]
+                xm, ym = xk.mean(), yk.mean()
+                slope = (np.dot(xk - xm, yk - ym) /
+                         np.dot(xk - xm, xk - xm))
+                residuals = y - slope * x
+                center = np.median(residuals[keep])
+                spread = self._MAD_SCALE * np.median(
+                    np.abs(residuals[keep] - center))
+                new_keep = (np.abs(residuals - center) <=
+                            self._threshold * max(spread, 1e-9))
+                if new_keep.sum() < self._min_points or \
+                        (new_keep == keep).all():
+                    break
+                keep = new_keep
+        elif slope is None:
+            # no nominal period: wait for enough observations
+            return
+
+        residuals = (y - slope * x)[keep]
+        self._slope = slope
+        self._offset = residuals.min()
+        self._jitter = residuals.std()
+        self._publish()
+
+    def to_host(self, indices, fit=None):
+        '''Host times of sample indices
+
+        Parameters
+        ----------
+        indices : array_like
+        fit : tuple, optional
+            A fit read from `fit`; defaults to the current one
+
+        Returns
+        -------
+        host_times : np.ndarray or float
+        '''
+        if fit is None:
+            fit = self._fit_state
+        if fit is None:
+            raise ValueError('Clock correlation has no fit yet')
+
+        origin_index, origin_time, offset, slope = fit
+        x = np.asarray(indices, dtype=np.float64) - origin_index
+        return origin_time + (offset + slope * x)
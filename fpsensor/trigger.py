@@ -0,0 +1,371 @@
+'''Triggered event capture on live position streams
+
+Rather than recording everything and searching afterwards, a Trigger
+evaluates conditions on every batch appended to a SampleStore and keeps
+only fixed-length records around the samples that fired::
+
+    trig = fps.trigger([Level(0, 1.5), Window(2, -0.1, 0.1)],
+                       pre=500, post=2000, holdoff=10.0)
+    trig.subscribe(event_writer('/data/events'))
+
+Conditions are evaluated on whole batches with numpy and fire on the edge
+of their state (e.g. when a level is crossed, not while it stays crossed),
+carrying their state across batches.  A rolling buffer provides the
+pre-trigger samples.  Events are handed to subscribers from a separate
+thread, so slow consumers (e.g. writing files) never hold back
+acquisition; holdoff and max_events bound the event rate during long
+unattended runs.
+'''
+import collections
+import logging
+import os
+import threading
+import numpy as np
+
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+from .stream import SampleStore
+
+
+logger = logging.getLogger(__name__)
+
+
+Event = collections.namedtuple(
+    'Event', 'time condition timestamps values trigger overrun')
+Event.__doc__ = '''A triggered record
+
+time : float
+    Timestamp of the sample that fired
+condition : Condition
+timestamps : np.ndarray, shape (n, )
+values : np.ndarray, shape (channels, n)
+    Up to pre samples before the trigger, the trigger sample and post
+    samples after it
+trigger : int
+    Position of the trigger sample in timestamps
+overrun : bool
+    Samples of the record were overwritten before it completed
+'''
+
+
+class Condition(object):
+    '''Base class of trigger conditions on one channel
+
+    Subclasses implement state(timestamps, values), a boolean per sample of
+    the batch; the condition fires on its rising edges.
+    '''
+    _DIRECTIONS = ('rising', 'falling', 'either')
+
+    def __init__(self, channel):
+        self.channel = int(channel)
+        self._prev = None
+
+    def __str__(self):
+        return '<{} channel={}>'.format(self.__class__.__name__,
+                                        self.channel)
+
+    def _check_direction(self, direction):
+        if direction not in self._DIRECTIONS:
+            raise ValueError('Unknown direction: {}'.format(direction))
+        return direction
+
+    def reset(self):
+        '''Forget the state carried across batches, e.g. after a gap'''
+        self._prev = None
+
+    def state(self, timestamps, values):
+        raise NotImplementedError()
+
+    def _edges(self, state, both=False):
+        prev = np.empty_like(state)
+        prev[0] = state[0] if self._prev is None else self._prev
+        prev[1:] = state[:-1]
+        self._prev = state[-1]
+        if both:
+            return state != prev
+        return state & ~prev
+
+    def triggers(self, timestamps, values):
+        '''Mask of the samples of a batch on which the condition fires'''
+        return self._edges(self.state(timestamps, values))
+
+
+class Level(Condition):
+    '''Fires when a channel crosses a threshold
+
+    Parameters
+    ----------
+    channel : int
+    threshold : float
+    direction : {'rising', 'falling', 'either'}, optional
+    '''
+    def __init__(self, channel, threshold, direction='rising'):
+        super(Level, self).__init__(channel)
+        self.threshold = threshold
+        self.direction = self._check_direction(direction)
+
+    def __str__(self):
+        return '<Level channel={0.channel} threshold={0.threshold} ' \
+               'direction={0.direction}>'.format(self)
+
+    def state(self, timestamps, values):
+        if self.direction == 'falling':
+            return values[self.channel] <= self.threshold
+        return values[self.channel] >= self.threshold
+
+    def triggers(self, timestamps, values):
+        return self._edges(self.state(timestamps, values),
+                           both=(self.direction == 'either'))
+
+
+class Slope(Condition):
+    '''Fires when the rate of change of a channel exceeds a threshold
+
+    Parameters
+    ----------
+    channel : int
+    threshold : float
+        Rate of change [units per second]
+    direction : {'rising', 'falling', 'either'}, optional
+    '''
+    def __init__(self, channel, threshold, direction='either'):
+        super(Slope, self).__init__(channel)
+        self.threshold = abs(threshold)
+        self.direction = self._check_direction(direction)
+        self._last = None
+
+    def __str__(self):
+        return '<Slope channel={0.channel} threshold={0.threshold} ' \
+               'direction={0.direction}>'.format(self)
+
+    def reset(self):
+        super(Slope, self).reset()
+        self._last = None
+
+    def state(self, timestamps, values):
+        x = values[self.channel]
+        if self._last is None:
+            self._last = (timestamps[0], x[0])
+
+        t_prev = np.empty_like(timestamps)
+        x_prev = np.empty_like(x, dtype=np.float64)
+        t_prev[0], x_prev[0] = self._last
+        t_prev[1:], x_prev[1:] = timestamps[:-1], x[:-1]
+        self._last = (timestamps[-1], x[-1])
+
+        dt = timestamps - t_prev
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.where(dt > 0, (x - x_prev) / dt, 0.0)
+
+        if self.direction == 'rising':
+            return slope >= self.threshold
+        elif self.direction == 'falling':
+            return slope <= -self.threshold
+        return np.abs(slope) >= self.threshold
+
+
+class Window(Condition):
+    '''Fires when a channel leaves the range [low, high]'''
+    def __init__(self, channel, low, high):
+        super(Window, self).__init__(channel)
+        if low > high:
+            raise ValueError('Empty window [{}, {}]'.format(low, high))
+        self.low = low
+        self.high = high
+
+    def __str__(self):
+        return '<Window channel={0.channel} low={0.low} ' \
+               'high={0.high}>'.format(self)
+
+    def state(self, timestamps, values):
+        x = values[self.channel]
+        return (x < self.low) | (x > self.high)
+
+
+class Trigger(object):
+    '''Capture fixed-length event records from a SampleStore
+
+    Any of the conditions starts a record.  Triggers during the post window
+    of a record belong to that record.
+
+    Parameters
+    ----------
+    store : SampleStore
+    conditions : sequence of Condition
+    pre : int, optional
+        Samples kept before the trigger sample
+    post : int, optional
+        Samples kept after the trigger sample
+    holdoff : float, optional
+        Minimum time [s, store time base] between triggers
+    max_events : int, optional
+        At most this many events per `per` seconds
+    per : float, optional
+        Period [s] of the max_events limit
+    history : int, optional
+        Number of recent events kept in `events`
+    max_queue : int, optional
+        Events queued for subscribers before dropping
+    '''
+    _MIN_BUFFER = 2 ** 16
+
+    def __init__(self, store, conditions, pre=1000, post=1000, holdoff=0.0,
+                 max_events=None, per=3600.0, history=100, max_queue=64):
+        self._store = store
+        self._conditions = list(conditions)
+        if not self._conditions:
+            raise ValueError('No trigger conditions')
+
+        self._pre = int(pre)
+        self._post = int(post)
+        self._holdoff = holdoff
+        self._max_events = max_events
+        self._per = per
+        self._buffer = SampleStore(
+            max(4 * (self._pre + self._post + 1), self._MIN_BUFFER),
+            channels=store.channels)
+
+        # (index, time, condition) of the record awaiting its post samples
+        self._pending = None
+        self._last_trigger = None
+        self._recent = collections.deque()
+        self._subscribers = []
+        self._queue = Queue.Queue(maxsize=max_queue)
+        self.events = collections.deque(maxlen=history)
+        self.count = 0
+        self.suppressed = 0
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._deliver_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+        store.subscribe(self._process)
+        store.subscribe_gaps(self._on_gap)
+
+    def __str__(self):
+        return '<Trigger conditions={0} count={1.count} ' \
+               'suppressed={1.suppressed}>'.format(
+                   [str(cond) for cond in self._conditions], self)
+
+    @property
+    def conditions(self):
+        return list(self._conditions)
+
+    def subscribe(self, callback):
+        '''Call callback(event) for every completed Event'''
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        try:
+            self._subscribers.remove(callback)
+        except ValueError:
+            pass
+
+    def _on_gap(self, gap):
+        # no edges or slopes across a break in the stream
+        for cond in self._conditions:
+            cond.reset()
+
+    def _process(self, timestamps, values):
+        base = self._buffer.count
+        self._buffer.append(timestamps, values)
+
+        fired = np.full(len(timestamps), -1)
+        for i, cond in enumerate(self._conditions):
+            fired[cond.triggers(timestamps, values) & (fired < 0)] = i
+
+        for pos in np.flatnonzero(fired >= 0):
+            self._complete(base + pos)
+            self._fire(base + pos, timestamps[pos],
+                       self._conditions[fired[pos]])
+        self._complete()
+
+    def _fire(self, index, time, condition):
+        if self._pending is not None:
+            # within the post window of the current record
+            return
+
+        if (self._last_trigger is not None and
+                time - self._last_trigger < self._holdoff):
+            self.suppressed += 1
+            return
+
+        if self._max_events is not None:
+            while self._recent and time - self._recent[0] >= self._per:
+                self._recent.popleft()
+            if len(self._recent) >= self._max_events:
+                self.suppressed += 1
+                return
+            self._recent.append(time)
+
+        self._last_trigger = time
+        self._pending = (index, time, condition)
+
+    def _complete(self, limit=None):
+        '''Emit the pending record once its post samples have arrived
+
+        Only samples before index limit count, when given.
+        '''
+        if self._pending is None:
+            return
+
+        index, time, condition = self._pending
+        end = index + self._post + 1
+        available = self._buffer.count
+        if limit is not None:
+            available = min(available, limit)
+        if available < end:
+            return
+
+        self._pending = None
+        snap = self._buffer.snapshot(since=max(0, index - self._pre))
+        num = end - snap.first
+        overrun = snap.overrun or num <= self._post
+        event = Event(time, condition, snap.timestamps[:num],
+                      snap.values[:, :num], max(0, index - snap.first),
+                      overrun)
+
+        self.count += 1
+        self.events.append(event)
+        try:
+            self._queue.put_nowait(event)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _deliver_loop(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                break
+
+            for callback in list(self._subscribers):
+                try:
+                    callback(event)
+                except Exception:
+                    logger.exception('Event subscriber %r failed', callback)
+
+    def close(self):
+        self._store.unsubscribe(self._process)
+        self._store.unsubscribe_gaps(self._on_gap)
+        self._queue.put(None)
+        self._thread.join()
+
+
+def event_writer(directory, prefix='event'):
+    '''Subscriber saving each event to an .npz file in directory'''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    def write(event):
+        filename = os.path.join(directory, '{}_{:.6f}.npz'.format(prefix,
+                                                                 event.time))
+        np.savez(filename, timestamps=event.timestamps, values=event.values,
+                 trigger=event.trigger, condition=str(event.condition),
+                 overrun=event.overrun)
+
+    return write
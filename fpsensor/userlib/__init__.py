@@ -2,5 +2,6 @@
 
 from .userlib import (discover, get_device_info, connect, disconnect,
                       get_position, get_positions, set_position_callback,
-                      FPSException)
+                      FPSException, get_backend, set_backend)
 from .device import (FPSDevice, FPSensor)
+from .group import FPSDeviceGroup
@@ -1,13 +1,22 @@
 from __future__ import print_function
 import threading
+import collections
 import ctypes
 import functools
 import time
 import logging
-import Queue
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
 import numpy as np
 
+from concurrent import futures
+
 from . import userlib
+from .. import rate
+from ..stream import (SampleStore, StreamSource)
+from ..timing import ClockCorrelator
 # from .userlib import FPSException
 
 
@@ -23,44 +32,97 @@ def _locked(fcn):
     return wrapped
 
 
-class FPSDevice(object):
+class FPSDevice(StreamSource):
+    '''A device found by FPSensor discovery
+
+    Parameters
+    ----------
+    lock : threading.Lock
+        Lock of the device table of the FPSensor
+    dev_num : int
+    ip_addr : str
+    id_num : int
+    connected : int
+    store_dtype : np.dtype, optional
+        Storage type of the picometre counts, see SampleStore.  np.int32
+        halves the memory of the store by keeping deltas from the first
+        sample, which must stay within +-2.1 mm (+-2.1e9 counts); larger
+        excursions are clipped and counted.
+    '''
     _TIME_SCALE_S = 1.024e-5
     _TIME_SCALE_MS = _TIME_SCALE_S * 1e3
+    _BUFFER_SIZE = 2 ** 20
+    # the library reports positions in nm, stored as picometre counts
+    _STORE_DTYPE = np.int64
+    _STORE_SCALE = 1e-3
 
-    def __init__(self, lock, dev_num, ip_addr, id_num, connected):
+    def __init__(self, lock, dev_num, ip_addr, id_num, connected,
+                 store_dtype=None):
         FPSDevice.instance = self  # TODO
         self._lock = lock
         self._dev_num = dev_num
         self._ip_addr = ip_addr
         self._id_num = id_num
         self._connected = connected
+        self._interface = userlib.IfAll
         self._monitoring = False
         self._sample_rate = None
         self._cb_queue = Queue.Queue()
         self._cb_thread = None
+        self._polling = False
+        self._time_base = None
+        self._fast_paths = []
+        if store_dtype is None:
+            store_dtype = self._STORE_DTYPE
+        self._store = SampleStore(self._BUFFER_SIZE, dtype=store_dtype,
+                                  scale=self._STORE_SCALE)
 
         self._reset()
 
     def _queue_handler(self):
         while self._monitoring:
             try:
-                count, seq_idx, pos = self._cb_queue.get(timeout=0.05)
+                dev, count, seq_idx, pos, host_time = \
+                    self._cb_queue.get(timeout=0.05)
             except Queue.Empty:
                 continue
 
-            self._monitor(count, seq_idx, pos)
+            try:
+                self._monitor(count, seq_idx, pos, host_time)
+            except Exception:
+                logger.exception('Ingestion failed for %s', self)
 
     def _reset(self):
         self._timestamp = None
-        self._timestamps = []
+        self._last_time = None
         self._next_idx = None
-        self._positions = [[] for i in range(3)]
-        self._timestamps = []
+        self._time_origin = None
+        self._reset_clock()
+        self._store.clear()
         self._filter_size = 32
         self._filter_data = None
         self._filtered = None
         self._cb_queue = Queue.Queue()
 
+    def _reset_clock(self):
+        period = None
+        if self._sample_rate is not None:
+            period = self.sample_rate * 1e-3
+        self._clock = ClockCorrelator(period=period)
+
+    def _update(self, dev_num, connected):
+        '''rescan found this device again, possibly renumbered'''
+        if dev_num != self._dev_num and (self._connected or
+                                         self._monitoring):
+            # the connection, position callback and poll thread are all
+            # bound to the number the device was connected under
+            logger.debug('Keeping %s under its number (rescan: %d)', self,
+                         dev_num)
+            return
+
+        self._dev_num = dev_num
+        self._connected = connected
+
     def _detached(self):
         '''device number handle is now stale'''
         self._lock = None
@@ -87,27 +149,91 @@ class FPSDevice(object):
     @property
     def positions(self):
         pos = (ctypes.c_double * 3)()
-        userlib.get_positions(self._dev_num, ctypes.byref(pos))
+        userlib.get_positions(self._dev_num, pos)
         return pos[:]
 
     @property
     def sample_rate(self):
         return self._sample_rate * self._TIME_SCALE_MS
 
-    def _monitor(self, count, seq_idx, positions):
+    @property
+    def clock(self):
+        '''ClockCorrelator mapping the device sequence index to host time'''
+        return self._clock
+
+    @property
+    def store(self):
+        '''The SampleStore filled while monitoring'''
+        return self._store
+
+    def _monitor(self, count, seq_idx, positions, host_time=None):
         dt = self.sample_rate
+        missed = 0
         if self._next_idx is not None and self._next_idx < seq_idx:
             print('missed position: got ', seq_idx, 'expected', self._next_idx)
             print('sequence difference: ', (seq_idx - self._next_idx))
-            self._timestamp += dt * (seq_idx - self._next_idx)
+            missed = seq_idx - self._next_idx
 
-        if self._timestamp is None:
-            self._timestamp = 0
+        if host_time is not None:
+            timestamps = self._correlate(count, seq_idx, host_time, missed)
+        else:
+            if self._timestamp is None:
+                self._timestamp = 0
+            self._timestamp += dt * missed
+            timestamps = (self._timestamp + dt * np.arange(count)) * 1e-3
 
-        self._next_idx = seq_idx + count
+        if missed:
+            self._store.mark_gap(self._last_time, timestamps[0],
+                                 'missed %d positions' % missed)
 
-        for i, all_pos in enumerate(self._positions):
-            all_pos.extend(positions[i, :])
+        self._next_idx = seq_idx + count
+        self._last_time = timestamps[-1]
+        self._timestamp = (timestamps[-1] * 1e3) + dt
+        self._ingest(timestamps, positions)
+
+    def _correlate(self, count, seq_idx, host_time, missed):
+        '''Timestamps [s] of a batch from the device/host clock fit'''
+        # read once: set_sample_rate replaces the clock from another thread
+        clock = self._clock
+        # the batch arrives right after its last sample was taken
+        clock.update(seq_idx + count - 1, host_time)
+        if self._time_origin is None:
+            if self._time_base is not None:
+                self._time_origin = self._time_base
+            else:
+                self._time_origin = float(clock.to_host(seq_idx))
+
+        timestamps = (clock.to_host(seq_idx + np.arange(count)) -
+                      self._time_origin)
+        if self._last_time is not None:
+            # a refit never moves samples much closer than the nominal
+            # period to their predecessors
+            floor = self._last_time + (0.5e-3 * self.sample_rate) * (
+                missed + np.arange(1, count + 1))
+            timestamps = np.maximum(timestamps, floor)
+        return timestamps
+
+    def _fast_timestamps(self, count, seq_idx, host_time):
+        '''Timestamps of a batch not yet ingested, for the fast paths'''
+        # read once: the ingest thread updates and may reset the fit
+        clock, origin = self._clock, self._time_origin
+        fit = clock.fit
+        if fit is not None and origin is not None:
+            return (clock.to_host(seq_idx + np.arange(count), fit=fit) -
+                    origin)
+
+        # first batch: its arrival time and the nominal period
+        if self._time_base is not None:
+            origin = self._time_base
+        else:
+            origin = host_time
+        return ((host_time - origin) -
+                (self.sample_rate * 1e-3) * np.arange(count - 1, -1, -1))
+
+    def _ingest(self, timestamps, positions):
+        '''Store a (3, n) batch of positions and update the filter'''
+        counts = np.rint(np.divide(positions, self._STORE_SCALE))
+        self._store.append(timestamps, counts.astype(np.int64))
 
         if self._filter_data is None and self._filter_size > 0:
             self._filter_data = [[positions[i, 0]] * self._filter_size
@@ -121,30 +247,30 @@ class FPSDevice(object):
                     filt[-1] = pos
                     self._filtered[i].append(np.average(filt))
 
-        for i in range(count):
-            self._timestamps.append(self._timestamp * 1e-3)
-            self._timestamp += dt
+    def _start_monitor(self, sample_rate, cb_queue, time_base=None):
+        '''Register the position callback, feeding batches into cb_queue
 
-    def monitor(self, sample_rate=1.0, wait_for=None, wait_timestamp=None):
-        '''
-        sample_rate: milliseconds
+        Queue items are (device, count, seq_idx, positions, host_time).  If
+        time_base (a time.monotonic() value) is given, timestamps are
+        relative to it instead of to the first sample.
         '''
-        if self._monitoring:
-            return
-
-        if self._cb_thread is not None:
-            self._cb_thread.join()
-
         self._reset()
+        self._cb_queue = cb_queue
+        self._time_base = time_base
+        self._polling = False
         self._sample_rate = int(float(sample_rate) / self._TIME_SCALE_MS)
 
         assert 1 <= self._sample_rate <= 100000, \
             'Invalid sample rate (%d)' % self._sample_rate
+        self._reset_clock()
+
+        registered_num = self._dev_num
 
         def callback(*args):
             try:
+                arrival = time.perf_counter()
                 dev_num, count, seq_idx, positions = args
-                if dev_num != self._dev_num:
+                if dev_num != registered_num:
                     return
                 elif not self._monitoring:
                     return
@@ -152,32 +278,152 @@ class FPSDevice(object):
                     print('count=', count)
                     return
 
-                # pos = np.array([positions[i][:count] for i in range(3)])
-                pos = np.array([[0] * count for i in range(3)])
-                queue_item = (count, seq_idx, pos)
-                self._cb_queue.put(queue_item)
+                host_time = time.monotonic()
+                pos = np.array([positions[i][:count] for i in range(3)])
+            except Exception as ex:
+                print('callback failure', ex, ex.__class__.__name__)
+                return
+
+            # a failing fast path must never cost the batch
+            fast_paths = self._fast_paths
+            if fast_paths:
+                try:
+                    timestamps = self._fast_timestamps(count, seq_idx,
+                                                       host_time)
+                    for fast in fast_paths:
+                        fast(timestamps, pos, arrival)
+                except Exception:
+                    logger.exception('Fast path dispatch failed')
+
+            try:
+                cb_queue.put((self, count, seq_idx, pos, host_time))
             except Exception as ex:
                 print('callback failure', ex, ex.__class__.__name__)
 
         self._callback_fcn = userlib.PositionCallback(callback)
-        userlib.set_position_callback(self._dev_num, self._sample_rate,
+        userlib.set_position_callback(registered_num, self._sample_rate,
                                       self._callback_fcn)
 
         self._monitoring = True
 
+    def monitor(self, sample_rate=1.0, wait_for=None, wait_timestamp=None):
+        '''
+        sample_rate: milliseconds
+        '''
+        if self._monitoring:
+            return
+
+        if self._cb_thread is not None:
+            self._cb_thread.join()
+
+        self._start_monitor(sample_rate, Queue.Queue())
+
         self._cb_thread = threading.Thread(target=self._queue_handler)
         self._cb_thread.daemon = True
         self._cb_thread.start()
 
+        self._wait(wait_for=wait_for, wait_timestamp=wait_timestamp)
+
+    def _wait(self, wait_for=None, wait_timestamp=None):
+        # returns early if acquisition stops, e.g. on a polling error
         if wait_for is not None and wait_for > 0:
-            while len(self._positions[0]) < wait_for:
+            while self._store.count < wait_for and self._monitoring:
                 time.sleep(0.05)
 
         elif wait_timestamp is not None and wait_timestamp > 0:
             wait_timestamp *= 1e3
-            while self._timestamp < wait_timestamp:
+            while ((self._timestamp is None or
+                    self._timestamp < wait_timestamp) and self._monitoring):
                 time.sleep(0.05)
 
+    def _poll_loop(self, period, block_size):
+        # get_positions writes straight into the rows of a preallocated
+        # block, which is handed to the store once full
+        block = np.zeros((block_size, 3))
+        timestamps = np.zeros(block_size)
+        pointers = [block[i].ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+                    for i in range(block_size)]
+
+        get_positions = userlib.get_positions
+        dev_num = self._dev_num
+        t0 = time.monotonic()
+        if self._time_base is not None:
+            t0 = self._time_base
+
+        idx = 0
+        next_time = time.monotonic()
+        while self._monitoring:
+            try:
+                get_positions(dev_num, pointers[idx])
+            except Exception:
+                logger.exception('Polling %s failed; acquisition stopped',
+                                 self)
+                self._monitoring = False
+                break
+
+            now = time.monotonic()
+            timestamps[idx] = now - t0
+
+            fast_paths = self._fast_paths
+            if fast_paths:
+                arrival = time.perf_counter()
+                for fast in fast_paths:
+                    fast(timestamps[idx:idx + 1], block[idx:idx + 1].T,
+                         arrival)
+            idx += 1
+
+            if idx == block_size:
+                self._timestamp = timestamps[-1] * 1e3
+                self._ingest(timestamps.copy(), block.T)
+                idx = 0
+
+            next_time += period
+            delay = next_time - now
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:
+                # fell behind; restart the schedule rather than bursting
+                next_time = now
+
+        if idx > 0:
+            self._timestamp = timestamps[idx - 1] * 1e3
+            self._ingest(timestamps[:idx].copy(), block[:idx].T)
+
+    def poll(self, sample_rate=1.0, block_size=64, wait_for=None,
+             wait_timestamp=None):
+        '''Acquire by polling get_positions from a rate-controlled thread
+
+        A fallback for the callback path of monitor(), filling the same
+        store.  Samples are timestamped with the host clock when read.
+
+        Parameters
+        ----------
+        sample_rate : float, optional
+            Polling period in milliseconds
+        block_size : int, optional
+            Number of samples handed to the store at once
+        '''
+        if self._monitoring:
+            return
+
+        if self._cb_thread is not None:
+            self._cb_thread.join()
+
+        assert sample_rate > 0, 'Invalid sample rate (%g)' % sample_rate
+        self._reset()
+        self._time_base = None
+        self._sample_rate = float(sample_rate) / self._TIME_SCALE_MS
+        self._polling = True
+        self._monitoring = True
+
+        self._cb_thread = threading.Thread(target=self._poll_loop,
+                                           args=(sample_rate * 1e-3,
+                                                 int(block_size)))
+        self._cb_thread.daemon = True
+        self._cb_thread.start()
+
+        self._wait(wait_for=wait_for, wait_timestamp=wait_timestamp)
+
     def stop(self):
         if not self._monitoring:
             return
@@ -190,58 +436,227 @@ class FPSDevice(object):
 
     @property
     def position_data(self):
-        num_pos = len(self._positions[0])
-        data = np.zeros((4, num_pos))
-        data[0, :] = self._timestamps
-        data[1, :] = self._positions[0]
-        data[2, :] = self._positions[1]
-        data[3, :] = self._positions[2]
-        return data
+        return self._store.data
 
+    def measure_sample_rate(self, duration=1.0):
+        '''Measure the stream currently delivered, see rate.measure_rate'''
+        return rate.measure_rate(self._store, duration,
+                                 nominal=self.sample_rate)
 
-class FPSensor(object):
-    def __init__(self):
-        self._lock = threading.Lock()
-        self._devices = []
+    def set_sample_rate(self, sample_rate, verify=True, duration=1.0):
+        '''Change the sample period [ms] and confirm it by measurement
 
-    def _clear_devices(self):
-        for dev in self._devices:
-            dev._detached()
+        The callback rate is changed in place while monitoring; otherwise
+        monitoring is started.
 
-        del self._devices[:]
+        Returns
+        -------
+        report : rate.RateReport or None
+            Measured delivery, if verify
+        '''
+        ticks = rate.to_ticks(sample_rate)
+        assert 1 <= ticks <= 100000, 'Invalid sample rate (%d)' % ticks
 
-    @_locked
-    def _find_devices(self, interface, wait=True):
-        dev_count = ctypes.c_uint()
+        if not self._monitoring:
+            self.monitor(sample_rate=sample_rate)
+        elif self._polling:
+            self.stop()
+            self.poll(sample_rate=sample_rate)
+        else:
+            userlib.set_position_callback(self._dev_num, ticks,
+                                          self._callback_fcn)
+            self._sample_rate = ticks
+            self._reset_clock()
+
+        if verify:
+            return self.measure_sample_rate(duration)
+
+    def auto_tune_sample_rate(self, min_period=rate.TIME_SCALE_MS,
+                              max_period=10.0, duration=1.0, max_drop=0.02):
+        '''Find the shortest sample period [ms] delivered without gaps
+
+        The device is left monitoring at the period found.
+
+        Returns
+        -------
+        report : rate.RateReport or None
+        '''
+        def probe(period):
+            return self.set_sample_rate(period, duration=duration)
 
-        while True:
+        return rate.auto_tune(probe, min_period, max_period,
+                              max_drop=max_drop)
+
+
+class FPSensor(object):
+    '''Device discovery with a cached device table
+
+    Devices are keyed by (id_num, ip_addr) and the same FPSDevice handle is
+    kept across rescans.  Discovery can run periodically in the background
+    (start_discovery), and subscribers are told about added and removed
+    devices.  The table lock is never held across a blocking discover call.
+
+    Parameters
+    ----------
+    store_dtype : np.dtype, optional
+        Storage type of the stores of the devices found, see FPSDevice
+    '''
+    DEVICE_ADDED = 'added'
+    DEVICE_REMOVED = 'removed'
+    _MAX_INFO_WORKERS = 8
+
+    def __init__(self, store_dtype=None):
+        self._lock = threading.Lock()
+        self._store_dtype = store_dtype
+        self._devices = collections.OrderedDict()
+        self._subscribers = []
+        self._scan_lock = threading.Lock()
+        self._scan_thread = None
+        self._scan_interface = None
+        self._scan_period = None
+        self._scanning = False
+        self._scanned = threading.Event()
+
+    def subscribe(self, callback):
+        '''Call callback(event, device) when a device is added or removed'''
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        try:
+            self._subscribers.remove(callback)
+        except ValueError:
+            pass
+
+    def _notify(self, event, device):
+        for callback in list(self._subscribers):
+            try:
+                callback(event, device)
+            except Exception:
+                logger.exception('Discovery subscriber %r failed', callback)
+
+    @staticmethod
+    def _query_info(dev_num):
+        addr = ctypes.create_string_buffer(16)
+        dev_id = ctypes.c_int()
+        connected = ctypes.c_int()
+        userlib.get_device_info(dev_num, ctypes.pointer(dev_id), addr,
+                                ctypes.pointer(connected))
+        return (dev_num, addr.value.decode('ascii', 'replace'), dev_id.value,
+                connected.value)
+
+    def _scan(self, interface):
+        '''Run a single discovery and update the device table'''
+        with self._scan_lock:
+            dev_count = ctypes.c_uint()
             userlib.discover(interface, ctypes.pointer(dev_count))
+            dev_count = dev_count.value
 
-            if wait and dev_count.value <= 0:
-                time.sleep(0.1)
-            else:
-                break
+            infos = []
+            if dev_count > 0:
+                workers = min(dev_count, self._MAX_INFO_WORKERS)
+                with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                    infos = list(pool.map(self._query_info, range(dev_count)))
 
-        self._clear_devices()
-        dev_count = dev_count.value
+        added, removed = [], []
+        with self._lock:
+            seen = set()
+            for dev_num, ip_addr, id_num, connected in infos:
+                key = (id_num, ip_addr)
+                seen.add(key)
+                device = self._devices.get(key)
+                if device is None:
+                    device = FPSDevice(self._lock, dev_num, ip_addr, id_num,
+                                       connected,
+                                       store_dtype=self._store_dtype)
+                    device._interface = interface
+                    self._devices[key] = device
+                    added.append(device)
+                else:
+                    device._update(dev_num, connected)
+
+            for key, device in list(self._devices.items()):
+                # only drop devices this scan could have seen
+                if key in seen or (device._interface & interface !=
+                                   device._interface):
+                    continue
+                del self._devices[key]
+                device._detached()
+                removed.append(device)
+
+        for device in added:
+            logger.debug('Device added: %s', device)
+            self._notify(self.DEVICE_ADDED, device)
+
+        for device in removed:
+            logger.debug('Device removed: %s', device)
+            self._notify(self.DEVICE_REMOVED, device)
+
+        self._scanned.set()
+        return self.devices
 
-        print('device count', dev_count)
+    def _scan_loop(self, interface, period):
+        while self._scanning:
+            try:
+                self._scan(interface)
+            except Exception:
+                logger.exception('Device discovery failed')
+            time.sleep(period)
+
+    def start_discovery(self, interface=userlib.IfAll, period=1.0):
+        '''Periodically rescan for devices in a background thread'''
+        if self._scan_thread is not None:
+            return
 
-        if dev_count <= 0:
-            return self.devices
+        self._scanned.clear()
+        self._scan_interface = interface
+        self._scan_period = period
+        self._scanning = True
+        self._scan_thread = threading.Thread(target=self._scan_loop,
+                                             args=(interface, period))
+        self._scan_thread.daemon = True
+        self._scan_thread.start()
+
+    def stop_discovery(self):
+        self._scanning = False
+        if self._scan_thread is not None:
+            self._scan_thread.join()
+            self._scan_thread = None
+            self._scan_interface = None
+            self._scan_period = None
+
+    def _find_devices(self, interface, wait=True, timeout=None):
+        t0 = time.time()
+        background = (self._scan_interface == interface)
 
-        for dev in range(dev_count):
-            addr = ctypes.create_string_buffer(16)
-            dev_id = ctypes.c_int()
-            connected = ctypes.c_int()
-            userlib.getDeviceInfo(dev, ctypes.pointer(dev_id), addr,
-                                  ctypes.pointer(connected))
+        while True:
+            scanned = False
+            if background:
+                # discovery thread is already scanning this interface; give
+                # it a couple of periods to complete a scan
+                limit = 0.0
+                if wait:
+                    limit = 2 * self._scan_period
+                    if timeout is not None:
+                        limit = max(0.0, min(limit,
+                                             timeout - (time.time() - t0)))
+                scanned = self._scanned.wait(limit)
+
+            if scanned:
+                devices = self.devices
+            else:
+                # not scanning, or no background scan succeeded (yet)
+                devices = self._scan(interface)
 
-            device = FPSDevice(self._lock, dev, addr.value, dev_id.value,
-                               connected.value)
-            self._devices.append(device)
+            if devices or not wait:
+                break
+            elif timeout is not None and (time.time() - t0) >= timeout:
+                break
 
-        return self.devices
+            time.sleep(0.1)
+
+        print('device count', len(devices))
+        return devices
 
     def find_tcp_devices(self, **kwargs):
         return self._find_devices(userlib.IfTcp, **kwargs)
@@ -252,6 +667,19 @@ class FPSensor(object):
     def find_usb_devices(self, **kwargs):
         return self._find_devices(userlib.IfUsb, **kwargs)
 
+    def get_device(self, id_num=None, ip_addr=None):
+        '''Look up a cached device by ID and/or IP address'''
+        for device in self.devices:
+            if id_num is not None and device._id_num != id_num:
+                continue
+            elif ip_addr is not None and device._ip_addr != ip_addr:
+                continue
+            return device
+
+        raise KeyError('No such device (id_num={} ip_addr={})'
+                       ''.format(id_num, ip_addr))
+
     @property
+    @_locked
     def devices(self):
-        return list(self._devices)
+        return list(self._devices.values())
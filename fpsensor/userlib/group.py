@@ -0,0 +1,165 @@
+from __future__ import print_function
+import threading
+import time
+import logging
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class FPSDeviceGroup(object):
+    '''Synchronized acquisition from several FPSDevices
+
+    All devices are started and stopped together, their callbacks feed one
+    shared queue drained by a single ingestion thread, and every device's
+    timestamps are relative to the same host time base (the group start
+    time).
+
+    Parameters
+    ----------
+    devices : sequence of FPSDevice
+    '''
+    def __init__(self, devices):
+        self._devices = list(devices)
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._running = False
+        self._time_base = None
+
+    def __str__(self):
+        return '<FPSDeviceGroup devices={0}>'.format(
+            [str(dev) for dev in self._devices])
+
+    @property
+    def devices(self):
+        return list(self._devices)
+
+    @property
+    def time_base(self):
+        '''Host time (time.monotonic) corresponding to timestamp 0'''
+        return self._time_base
+
+    @property
+    def monitoring(self):
+        return self._running
+
+    def _ingest_loop(self):
+        while self._running:
+            try:
+                dev, count, seq_idx, pos, host_time = \
+                    self._queue.get(timeout=0.05)
+            except Queue.Empty:
+                continue
+
+            try:
+                dev._monitor(count, seq_idx, pos, host_time)
+            except Exception:
+                logger.exception('Ingestion failed for %s', dev)
+
+    def start(self, sample_rate=1.0, wait_for=None, wait_timestamp=None):
+        '''Start monitoring all devices on a common time base
+
+        Parameters
+        ----------
+        sample_rate : float, optional
+            Sample period in milliseconds, applied to every device
+        wait_for : int, optional
+            Block until every device has this many samples
+        wait_timestamp : float, optional
+            Block until every device has reached this timestamp [s]
+        '''
+        if self._running:
+            return
+
+        if self._thread is not None:
+            self._thread.join()
+
+        self._queue = Queue.Queue()
+        self._time_base = time.monotonic()
+        self._running = True
+
+        self._thread = threading.Thread(target=self._ingest_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+        try:
+            for dev in self._devices:
+                dev._start_monitor(sample_rate, self._queue,
+                                   time_base=self._time_base)
+        except Exception:
+            self.stop()
+            raise
+
+        for dev in self._devices:
+            dev._wait(wait_for=wait_for, wait_timestamp=wait_timestamp)
+
+    def stop(self):
+        for dev in self._devices:
+            dev._monitoring = False
+
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def position_data(self, period=None, method='interp'):
+        '''Merge all devices into a single time-aligned array
+
+        Only the time range covered by every device is returned.
+
+        Parameters
+        ----------
+        period : float, optional
+            Spacing of the common time grid [s].  Defaults to the slowest
+            device sample period.
+        method : {'interp', 'nearest'}, optional
+            Resample by linear interpolation or take the nearest sample
+
+        Returns
+        -------
+        data : np.ndarray, shape (1 + 3 * len(devices), n)
+            Row 0 holds the common timestamps, followed by the three axes of
+            each device in order
+        '''
+        if method not in ('interp', 'nearest'):
+            raise ValueError('Unknown merge method: {}'.format(method))
+
+        all_data = [dev.position_data for dev in self._devices]
+        num_rows = 1 + 3 * len(all_data)
+        if not all_data or any(data.shape[1] == 0 for data in all_data):
+            return np.zeros((num_rows, 0))
+
+        if period is None:
+            period = max(dev.sample_rate for dev in self._devices) * 1e-3
+
+        start = max(data[0, 0] for data in all_data)
+        stop = min(data[0, -1] for data in all_data)
+        if stop < start:
+            return np.zeros((num_rows, 0))
+
+        timestamps = start + period * np.arange(
+            int(np.floor((stop - start) / period)) + 1)
+
+        merged = np.zeros((num_rows, len(timestamps)))
+        merged[0, :] = timestamps
+        for i, data in enumerate(all_data):
+            rows = slice(1 + 3 * i, 4 + 3 * i)
+            if method == 'interp':
+                for j in range(3):
+                    merged[rows.start + j, :] = np.interp(timestamps, data[0],
+                                                          data[1 + j])
+            elif data.shape[1] == 1:
+                merged[rows, :] = data[1:, :1]
+            else:
+                idx = np.clip(np.searchsorted(data[0], timestamps), 1,
+                              data.shape[1] - 1)
+                earlier = ((timestamps - data[0, idx - 1]) <
+                           (data[0, idx] - timestamps))
+                merged[rows, :] = data[1:, np.where(earlier, idx - 1, idx)]
+
+        return merged
@@ -0,0 +1,221 @@
+'''Pure-Python stand-in for libfps3010
+
+Install with::
+
+    from fpsensor.userlib import userlib, sim
+    userlib.set_backend(sim.SimulatedBackend(num_devices=2))
+
+or set the environment variable FPS_BACKEND=sim before first use.
+'''
+import ctypes
+import threading
+import time
+import numpy as np
+
+from ctypes import (POINTER, c_double, c_int, c_uint)
+
+from . import userlib
+
+
+class SimulatedDevice(object):
+    '''A simulated interferometer
+
+    Each axis reports a sinusoidal vibration on top of a constant offset,
+    plus Gaussian noise.
+
+    Parameters
+    ----------
+    id_num : int
+    ip_addr : str
+    offsets : sequence of float, optional
+        Per-axis position offsets
+    amplitude : float, optional
+        Vibration amplitude
+    frequency : float, optional
+        Vibration frequency [Hz]
+    noise : float, optional
+        Standard deviation of the noise
+    '''
+    def __init__(self, id_num, ip_addr, offsets=(0.0, 0.0, 0.0),
+                 amplitude=0.01, frequency=50.0, noise=0.001):
+        self.id_num = id_num
+        self.ip_addr = ip_addr
+        self.offsets = np.asarray(offsets, dtype=float)[:, np.newaxis]
+        self.amplitude = amplitude
+        self.frequency = frequency
+        self.noise = noise
+        self.connected = False
+
+        self._callback = None
+        self._sample_period = None
+        self._thread = None
+        self._t0 = time.monotonic()
+
+    def __str__(self):
+        return '<SimulatedDevice id_num={0.id_num} ip_addr={0.ip_addr} ' \
+               'connected={0.connected}>'.format(self)
+
+    def positions_at(self, times):
+        '''Positions of all three axes at the given times, shape (3, n)'''
+        times = np.atleast_1d(times)
+        phase = 2.0 * np.pi * self.frequency * times
+        pos = self.offsets + self.amplitude * np.sin(phase)
+        if self.noise > 0:
+            pos = pos + np.random.normal(0.0, self.noise, pos.shape)
+        return pos
+
+    def positions(self):
+        return self.positions_at(time.monotonic() - self._t0)[:, 0]
+
+
+class SimulatedBackend(object):
+    '''Backend implementing the libfps3010 calls in Python
+
+    Position callbacks are delivered from one thread per device, in
+    batches of callback_size samples.
+
+    Parameters
+    ----------
+    devices : sequence of SimulatedDevice, optional
+    num_devices : int, optional
+        Number of default devices to create if devices is not given
+    callback_size : int, optional
+        Samples per position callback
+    callback_period : float, optional
+        Seconds between callbacks.  Defaults to real time (callback_size
+        sample periods); 0 delivers as fast as possible.
+    drop_probability : float, optional
+        Probability that a batch is skipped, leaving a gap in the device
+        sequence index
+    '''
+    _TIME_SCALE_S = 1.024e-5
+
+    def __init__(self, devices=None, num_devices=1, callback_size=100,
+                 callback_period=None, drop_probability=0.0):
+        if devices is None:
+            devices = [SimulatedDevice(id_num=i + 1,
+                                       ip_addr='10.0.0.%d' % (i + 1))
+                       for i in range(num_devices)]
+
+        self.devices = list(devices)
+        self.callback_size = int(callback_size)
+        self.callback_period = callback_period
+        self.drop_probability = drop_probability
+        self._discovered = []
+
+    def _device(self, dev_num):
+        if dev_num >= len(self._discovered):
+            return None
+        return self._discovered[dev_num]
+
+    def discover(self, interface, dev_count):
+        if interface == userlib.IfNone:
+            self._discovered = []
+        else:
+            self._discovered = list(self.devices)
+        ctypes.cast(dev_count, POINTER(c_uint))[0] = len(self._discovered)
+        return userlib.Success
+
+    def get_device_info(self, dev_num, dev_id, addr, connected):
+        device = self._device(dev_num)
+        if device is None:
+            return userlib.NoDevice
+
+        ip_addr = device.ip_addr.encode('ascii') + b'\0'
+        ctypes.cast(dev_id, POINTER(c_int))[0] = device.id_num
+        ctypes.memmove(addr, ip_addr, len(ip_addr))
+        ctypes.cast(connected, POINTER(c_int))[0] = int(device.connected)
+        return userlib.Success
+
+    def connect(self, dev_num):
+        device = self._device(dev_num)
+        if device is None:
+            return userlib.NoDevice
+        elif device.connected:
+            return userlib.DeviceLocked
+
+        device.connected = True
+        return userlib.Success
+
+    def disconnect(self, dev_num):
+        device = self._device(dev_num)
+        if device is None:
+            return userlib.NoDevice
+        elif not device.connected:
+            return userlib.NotConnected
+
+        device._callback = None
+        device.connected = False
+        return userlib.Success
+
+    def get_position(self, dev_num, axis, position):
+        device = self._device(dev_num)
+        if device is None:
+            return userlib.NoDevice
+        elif not device.connected:
+            return userlib.NotConnected
+        elif not 0 <= axis < 3:
+            return userlib.Error
+
+        ctypes.cast(position, POINTER(c_double))[0] = \
+            device.positions()[axis]
+        return userlib.Success
+
+    def get_positions(self, dev_num, positions):
+        device = self._device(dev_num)
+        if device is None:
+            return userlib.NoDevice
+        elif not device.connected:
+            return userlib.NotConnected
+
+        ptr = ctypes.cast(positions, POINTER(c_double))
+        for axis, pos in enumerate(device.positions()):
+            ptr[axis] = pos
+        return userlib.Success
+
+    def set_position_callback(self, dev_num, sample_rate, callback):
+        device = self._device(dev_num)
+        if device is None:
+            return userlib.NoDevice
+        elif not device.connected:
+            return userlib.NotConnected
+
+        device._callback = callback
+        device._sample_period = sample_rate * self._TIME_SCALE_S
+        if callback is not None and device._thread is None:
+            device._thread = threading.Thread(
+                target=self._callback_loop, args=(dev_num, device))
+            device._thread.daemon = True
+            device._thread.start()
+        return userlib.Success
+
+    def _callback_loop(self, dev_num, device):
+        count = self.callback_size
+        offsets = np.arange(count)
+        seq_idx = 0
+        next_time = time.monotonic()
+        try:
+            while device._callback is not None:
+                callback = device._callback
+                sample_period = device._sample_period
+                period = self.callback_period
+                if period is None:
+                    period = sample_period * count
+
+                if (self.drop_probability <= 0 or
+                        np.random.random() >= self.drop_probability):
+                    times = (seq_idx + offsets) * sample_period
+                    pos = np.ascontiguousarray(device.positions_at(times))
+                    ptrs = (POINTER(c_double) * 3)(
+                        *[pos[i].ctypes.data_as(POINTER(c_double))
+                          for i in range(3)])
+                    callback(dev_num, count, seq_idx, ptrs)
+
+                seq_idx += count
+                if period > 0:
+                    next_time += period
+                    delay = next_time - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+        finally:
+            device._thread = None
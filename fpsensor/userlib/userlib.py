@@ -1,3 +1,4 @@
+import os
 import ctypes
 import functools
 
@@ -29,8 +30,6 @@ def check_retval(fcn):
     return wrapped
 
 
-shlib = ctypes.cdll.LoadLibrary('libfps3010.so')
-
 IfNone = 0  # fps3010.h: 66
 IfUsb = 1  # fps3010.h: 66
 IfTcp = 2  # fps3010.h: 66
@@ -39,49 +38,133 @@ IfAll = 3  # fps3010.h: 66
 InterfaceType = c_int  # fps3010.h: 66
 
 # fps3010.h: 95
+# const double * const pos[3] decays to a pointer to the three axis arrays
 PositionCallback = CFUNCTYPE(c_void_p, c_uint, c_uint, c_uint,
-                             POINTER(c_double) * 3)
+                             POINTER(POINTER(c_double)))
+
+
+class LibraryBackend(object):
+    '''Backend calling into the vendor shared library
+
+    The library is only loaded on the first call, so that importing
+    fpsensor.userlib works on machines without it.
+    '''
+    # name: (C function, argtypes)
+    _prototypes = {
+        # fps3010.h: 115
+        'discover': ('FPS_discover', [InterfaceType, POINTER(c_uint)]),
+        # fps3010.h: 133
+        'get_device_info': ('FPS_getDeviceInfo',
+                            [c_uint, POINTER(c_int), c_char_p,
+                             POINTER(c_int)]),
+        # fps3010.h: 146
+        'connect': ('FPS_connect', [c_uint]),
+        # fps3010.h: 155
+        'disconnect': ('FPS_disconnect', [c_uint]),
+        # fps3010.h: 166
+        'get_position': ('FPS_getPosition',
+                         [c_uint, c_uint, POINTER(c_double)]),
+        # fps3010.h: 178
+        'get_positions': ('FPS_getPositions', [c_uint, POINTER(c_double)]),
+        # fps3010.h: 194
+        'set_position_callback': ('FPS_setPositionCallback',
+                                  [c_uint, c_uint, PositionCallback]),
+    }
+
+    def __init__(self, libname='libfps3010.so'):
+        self._libname = libname
+        self._shlib = None
+
+    def __str__(self):
+        return '<LibraryBackend libname={0._libname}>'.format(self)
+
+    @property
+    def shlib(self):
+        if self._shlib is None:
+            shlib = ctypes.cdll.LoadLibrary(self._libname)
+            for name, (c_name, argtypes) in self._prototypes.items():
+                fcn = getattr(shlib, c_name)
+                fcn.argtypes = argtypes
+                fcn.restype = c_int
+                setattr(self, name, fcn)
+            self._shlib = shlib
+        return self._shlib
+
+    def __getattr__(self, name):
+        # C functions are bound as instance attributes once loaded
+        if name not in self._prototypes:
+            raise AttributeError(name)
+        self.shlib
+        return self.__dict__[name]
+
+
+_backend = None
+
+
+def get_backend():
+    '''The active backend, created on first use
+
+    Setting the environment variable FPS_BACKEND=sim selects the simulated
+    backend instead of the vendor library.
+    '''
+    global _backend
+    if _backend is None:
+        if os.environ.get('FPS_BACKEND', '').lower() == 'sim':
+            from .sim import SimulatedBackend
+            _backend = SimulatedBackend()
+        else:
+            _backend = LibraryBackend()
+    return _backend
+
+
+def set_backend(backend):
+    '''Replace the backend used by all userlib functions
+
+    Parameters
+    ----------
+    backend : LibraryBackend, SimulatedBackend or compatible object
+        Must provide discover, get_device_info, connect, disconnect,
+        get_position, get_positions and set_position_callback with the
+        signatures and return codes of the C library.
+    '''
+    global _backend
+    _backend = backend
+
 
-# fps3010.h: 115
-discover = check_retval(shlib.FPS_discover)
-discover.argtypes = [InterfaceType, POINTER(c_uint)]
-discover.restype = c_int
+@check_retval
+def discover(interface, dev_count):
+    return get_backend().discover(interface, dev_count)
 
 
-# fps3010.h: 133
-get_device_info = check_retval(shlib.FPS_getDeviceInfo)
-get_device_info.argtypes = [c_uint, POINTER(c_int), c_char_p, POINTER(c_int)]
-get_device_info.restype = c_int
+@check_retval
+def get_device_info(dev_num, dev_id, addr, connected):
+    return get_backend().get_device_info(dev_num, dev_id, addr, connected)
 
 
-# fps3010.h: 146
-connect = check_retval(shlib.FPS_connect)
-connect.argtypes = [c_uint]
-connect.restype = c_int
+@check_retval
+def connect(dev_num):
+    return get_backend().connect(dev_num)
 
 
-# fps3010.h: 155
-disconnect = check_retval(shlib.FPS_disconnect)
-disconnect.argtypes = [c_uint]
-disconnect.restype = c_int
+@check_retval
+def disconnect(dev_num):
+    return get_backend().disconnect(dev_num)
 
 
-# fps3010.h: 166
-get_position = check_retval(shlib.FPS_getPosition)
-get_position.argtypes = [c_uint, c_uint, POINTER(c_double)]
-get_position.restype = c_int
+@check_retval
+def get_position(dev_num, axis, position):
+    return get_backend().get_position(dev_num, axis, position)
 
 
-# fps3010.h: 178
-get_positions = check_retval(shlib.FPS_getPositions)
-get_positions.argtypes = [c_uint, POINTER(c_double)]
-get_positions.restype = c_int
+@check_retval
+def get_positions(dev_num, positions):
+    return get_backend().get_positions(dev_num, positions)
 
 
-# fps3010.h: 194
-set_position_callback = check_retval(shlib.FPS_setPositionCallback)
-set_position_callback.argtypes = [c_uint, c_uint, PositionCallback]
-set_position_callback.restype = c_int
+@check_retval
+def set_position_callback(dev_num, sample_rate, callback):
+    return get_backend().set_position_callback(dev_num, sample_rate,
+                                               callback)
 
 
 # fps3010.h: 49
@@ -0,0 +1,215 @@
+'''Incremental live plot of a sample stream
+
+Instead of redrawing every sample, LivePlot keeps a per-pixel min/max
+envelope of the last `window` seconds, updated batch by batch as samples
+are appended to the store, and redraws only its lines with blitting.  The
+cost of a redraw depends on the width of the plot, not on the amount of
+data.
+
+    plot = LivePlot(fps.store, channels=[0, 1], window=10.0)
+    plot.run(interval=0.1)
+'''
+from __future__ import print_function
+import threading
+import numpy as np
+import matplotlib.pyplot as plt
+
+
+class LivePlot(object):
+    '''Min/max envelope plot of the newest samples of a SampleStore
+
+    The x axis is time relative to the newest sample, so the axes stay
+    fixed and only the lines are redrawn; the background is re-rendered
+    only when the y range has to grow or shrink.
+
+    Parameters
+    ----------
+    store : SampleStore
+    channels : sequence of int, optional
+        Store channels to plot
+    window : float, optional
+        Seconds of data shown
+    ax : matplotlib.axes.Axes, optional
+        Defaults to the current axes
+    width : int, optional
+        Number of envelope bins; defaults to the axes width in pixels
+    colors : str, optional
+    labels : sequence of str, optional
+    scale : float, optional
+        Factor applied to the values, e.g. 1e3 to plot um as nm
+    '''
+    def __init__(self, store, channels=(0, ), window=10.0, ax=None,
+                 width=None, colors='bgk', labels=None, scale=1.0):
+        if ax is None:
+            ax = plt.gca()
+
+        self._store = store
+        self._channels = list(channels)
+        self._window = float(window)
+        self._ax = ax
+        self._canvas = ax.figure.canvas
+        self._scale = scale
+
+        if width is None:
+            width = ax.bbox.width
+        self._bins = max(2, int(width))
+        self._bin_width = self._window / self._bins
+
+        self._lock = threading.Lock()
+        self._mins = np.full((len(self._channels), self._bins), np.inf)
+        self._maxs = np.full((len(self._channels), self._bins), -np.inf)
+        self._last_bin = None
+
+        if labels is None:
+            labels = ['Axis %d' % (ch + 1) for ch in self._channels]
+
+        self._lines = [ax.plot([], [], color, label=label, animated=True,
+                               lw=1)[0]
+                       for color, label in zip(colors, labels)]
+        ax.set_xlim(-self._window, 0)
+        ax.set_xlabel('Time [s]')
+        ax.legend(loc='upper left')
+
+        self._background = None
+        self._cid = self._canvas.mpl_connect('draw_event', self._on_draw)
+        store.subscribe(self._add)
+
+    def __str__(self):
+        return '<LivePlot channels={0._channels} window={0._window} ' \
+               'bins={0._bins}>'.format(self)
+
+    def _add(self, timestamps, values):
+        '''Fold a batch into the envelope (called by the store)'''
+        bins = np.floor(np.asarray(timestamps) /
+                        self._bin_width).astype(np.int64)
+        values = np.asarray(values)[self._channels] * self._scale
+
+        with self._lock:
+            newest = bins[-1]
+            if self._last_bin is None:
+                self._last_bin = newest
+            elif newest > self._last_bin:
+                # clear the bins scrolling into the window
+                num = min(newest - self._last_bin, self._bins)
+                idx = (self._last_bin + 1 + np.arange(num)) % self._bins
+                self._mins[:, idx] = np.inf
+                self._maxs[:, idx] = -np.inf
+                self._last_bin = newest
+
+            keep = bins > self._last_bin - self._bins
+            if not keep.all():
+                bins, values = bins[keep], values[:, keep]
+            if not len(bins):
+                return
+
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+            idx = bins[starts] % self._bins
+            self._mins[:, idx] = np.minimum(
+                self._mins[:, idx], np.minimum.reduceat(values, starts,
+                                                        axis=1))
+            self._maxs[:, idx] = np.maximum(
+                self._maxs[:, idx], np.maximum.reduceat(values, starts,
+                                                        axis=1))
+
+    def envelope(self):
+        '''Current envelope, oldest bin first
+
+        Returns
+        -------
+        times : np.ndarray, shape (bins, )
+            Bin start relative to the newest bin [s]
+        mins, maxs : np.ndarray, shape (channels, bins)
+            NaN where a bin holds no samples
+        '''
+        with self._lock:
+            if self._last_bin is None:
+                last_bin = 0
+            else:
+                last_bin = self._last_bin
+            rel = np.arange(1 - self._bins, 1)
+            idx = (last_bin + rel) % self._bins
+            mins = self._mins[:, idx]
+            maxs = self._maxs[:, idx]
+
+        empty = np.isinf(mins)
+        mins[empty] = np.nan
+        maxs[empty] = np.nan
+        return rel * self._bin_width, mins, maxs
+
+    def _on_draw(self, event):
+        self._background = self._canvas.copy_from_bbox(self._ax.bbox)
+        self._draw_lines()
+
+    def _draw_lines(self):
+        for line in self._lines:
+            self._ax.draw_artist(line)
+
+    def _rescale(self, mins, maxs):
+        '''Fit the y range to the data; True if it changed'''
+        if np.isnan(mins).all():
+            return False
+
+        low, high = np.nanmin(mins), np.nanmax(maxs)
+        y0, y1 = self._ax.get_ylim()
+        span = (y1 - y0)
+        # grow immediately, shrink only once the data uses little of it
+        if low >= y0 and high <= y1 and (high - low) > 0.25 * span:
+            return False
+
+        margin = 0.1 * max(high - low, 1e-12)
+        self._ax.set_ylim(low - margin, high + margin)
+        return True
+
+    def update(self):
+        '''Redraw the lines from the current envelope'''
+        times, mins, maxs = self.envelope()
+
+        # a vertical stroke per bin, from its minimum to its maximum
+        x = np.repeat(times, 2)
+        for line, lo, hi in zip(self._lines, mins, maxs):
+            y = np.empty(2 * len(times))
+            y[0::2] = lo
+            y[1::2] = hi
+            line.set_data(x, y)
+
+        if self._rescale(mins, maxs) or self._background is None:
+            # full redraw, which caches the new background via _on_draw
+            self._canvas.draw()
+        else:
+            self._canvas.restore_region(self._background)
+            self._draw_lines()
+            self._canvas.blit(self._ax.bbox)
+        self._canvas.flush_events()
+
+    def run(self, interval=0.1, duration=None):
+        '''Update every interval seconds, for duration or until closed'''
+        plt.show(block=False)
+        elapsed = 0.0
+        while plt.fignum_exists(self._ax.figure.number):
+            self.update()
+            self._canvas.start_event_loop(interval)
+            elapsed += interval
+            if duration is not None and elapsed >= duration:
+                break
+
+    def close(self):
+        self._store.unsubscribe(self._add)
+        self._canvas.mpl_disconnect(self._cid)
+
+
+if __name__ == '__main__':
+    from fpsensor.userlib import (FPSensor, set_backend)
+    from fpsensor.userlib.sim import SimulatedBackend
+
+    set_backend(SimulatedBackend(callback_size=100))
+    dev = FPSensor().find_devices()[0]
+    dev.connect()
+    dev.monitor(sample_rate=0.1)
+
+    plt.figure()
+    plot = LivePlot(dev.store, channels=[0, 1, 2], window=5.0)
+    try:
+        plot.run(interval=0.1)
+    finally:
+        plot.close()
+        dev.stop()
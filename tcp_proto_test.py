@@ -9,6 +9,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from fft_plot import fftplot
+from live_plot import LivePlot
 from fpsensor.proto import FPSensor
 
 
@@ -63,8 +64,10 @@ def plot_thread():
     while True:
         plt.figure(0)
         plt.clf()
-        idx, = np.where(fps.positions[0, :] > 0)
-        pos = fps.positions[:, idx]
+        snap = fps.store.snapshot()
+        if snap.overrun:
+            print('plot fell behind acquisition')
+        pos = np.vstack((snap.timestamps, snap.values))
         plt.plot(pos[0, :], pos[1, :], label='Axis 1')
         # plt.plot(pos[1, :], label='Axis 2')
         # plt.plot(pos[2, :], label='Axis 3')
@@ -138,4 +141,18 @@ def plot_test():
         fps.stop()
 
 
+def live_plot_test():
+    '''Envelope plot of all three axes, redrawn incrementally'''
+    fps.start_polling(0.005)
+    plot = LivePlot(fps.store, channels=[0, 1, 2], window=20.0, scale=1e3)
+    plt.ylabel('Position [nm]')
+    try:
+        plot.run(interval=0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        plot.close()
+        fps.stop()
+
+
 simple_test()
@@ -0,0 +1,183 @@
+'''The TCP FPSensor against a minimal in-process telegram server'''
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from fpsensor.proto import FPSensor
+from fpsensor.proto.telegram import (ACK, GET, ID_FPS_SAMPLE_TIME,
+                                     ID_FPS_SYNC_POS)
+
+
+class FakeSensor(object):
+    '''Acknowledges every telegram, as far as told to
+
+    GETs of SYNC_POS return positions growing with every request, other
+    GETs the last value set.  Telegrams for which drop(opcode, address) is
+    true go unanswered.  Setting truncate sends only the start of the next
+    acknowledgement, after which that connection goes silent.
+    '''
+    def __init__(self):
+        self.registers = {}
+        self.received = 0
+        self.drop = lambda opcode, address: False
+        self.truncate = False
+        self._silent = set()
+        self._conns = []
+        self._server = socket.socket()
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(5)
+        self.port = self._server.getsockname()[1]
+
+        thread = threading.Thread(target=self._accept_loop)
+        thread.daemon = True
+        thread.start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except socket.error:
+                return
+
+            self._conns.append(conn)
+            thread = threading.Thread(target=self._serve, args=(conn, ))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        buf = b''
+        while True:
+            try:
+                data = conn.recv(4096)
+            except socket.error:
+                return
+            if not data:
+                return
+
+            buf += data
+            while len(buf) >= 4:
+                length, = struct.unpack('<i', buf[:4])
+                if len(buf) < length + 4:
+                    break
+
+                tel, buf = buf[:length + 4], buf[length + 4:]
+                self.received += 1
+                try:
+                    self._respond(conn, tel)
+                except socket.error:
+                    return
+
+    def _respond(self, conn, tel):
+        _, opcode, address, index, seq = struct.unpack('<5i', tel[:20])
+        if conn in self._silent or self.drop(opcode, address):
+            return
+
+        if opcode == GET and address == ID_FPS_SYNC_POS:
+            n = self.received
+            data = [1000 * n, 0, 2000 * n, 0, 3000 * n, 0]
+        elif opcode == GET:
+            data = [self.registers.get((address, index), 0)]
+        else:
+            data = list(struct.unpack('<%di' % ((len(tel) - 20) // 4),
+                                      tel[20:]))
+            self.registers[(address, index)] = data[0]
+
+        body = struct.pack('<6i', 0, ACK, address, index, seq, 0)
+        body += struct.pack('<%di' % len(data), *data)
+        body = struct.pack('<i', len(body) - 4) + body[4:]
+        if self.truncate:
+            self.truncate = False
+            self._silent.add(conn)
+            body = body[:12]
+        conn.sendall(body)
+
+    def close(self):
+        self._server.close()
+        for conn in self._conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
+
+
+def wait_until(condition, timeout=5.0):
+    t0 = time.monotonic()
+    while not condition():
+        assert (time.monotonic() - t0) < timeout, 'Timed out'
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def server():
+    server = FakeSensor()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def sensor(server):
+    fps = FPSensor('127.0.0.1', server.port, stall_timeout=0.5)
+    yield fps
+    fps.stop()
+
+
+def test_read_registers_without_run(server, sensor):
+    # the receive thread is started on demand
+    server.registers[(0x123, 0)] = 42
+    assert sensor.read_registers([0x123], timeout=1.0) == [[42]]
+
+
+def test_set_sample_rate(server, sensor):
+    report = sensor.set_sample_rate(2.0, duration=0.3)
+    assert server.registers[(ID_FPS_SAMPLE_TIME, 0)] == 195
+    assert report.samples > 0
+    assert report.gaps == 0
+
+
+def test_stall_within_telegram(server, sensor):
+    sensor.start_polling(0.01)
+    wait_until(lambda: sensor.store.count > 5)
+
+    # a partial acknowledgement, then silence: reconnect and carry on
+    server.truncate = True
+    wait_until(lambda: sensor.outages)
+    assert 'within a telegram' in sensor.outages[0][2]
+    count = sensor.store.count
+    wait_until(lambda: sensor.store.count > count + 5)
+
+
+def test_lost_acknowledgement(server, sensor):
+    lost = []
+
+    def drop_once(opcode, address):
+        if address == ID_FPS_SYNC_POS and not lost:
+            lost.append(server.received)
+            return True
+        return False
+
+    server.drop = drop_once
+    sensor.start_polling(0.01)
+    wait_until(lambda: lost and sensor.store.count > 5)
+    sensor.stop_polling()
+
+    # a request the device never answered is not a stall
+    time.sleep(1.0)
+    assert not sensor._is_stalled()
+    assert sensor.outages == []
+
+
+def test_stalled_acknowledgements(server, sensor):
+    sensor.start_polling(0.01)
+    wait_until(lambda: sensor.store.count > 5)
+
+    server.drop = lambda opcode, address: True
+    wait_until(lambda: sensor.outages)
+    assert sensor.outages[0][2] == 'acknowledgements stalled'
+
+    server.drop = lambda opcode, address: False
+    count = sensor.store.count
+    wait_until(lambda: sensor.store.count > count + 5)
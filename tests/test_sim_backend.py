@@ -0,0 +1,196 @@
+'''Acquisition from the userlib wrapper against the simulated backend'''
+import time
+
+import numpy as np
+import pytest
+
+from fpsensor.userlib import FPSensor, userlib
+from fpsensor.userlib.sim import SimulatedBackend, SimulatedDevice
+
+
+def wait_count(store, num, timeout=10.0):
+    t0 = time.monotonic()
+    while store.count < num:
+        assert (time.monotonic() - t0) < timeout, \
+            'Only {} of {} samples after {}s'.format(store.count, num,
+                                                     timeout)
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def simulated(monkeypatch):
+    '''Install a SimulatedBackend for one test, restoring the previous one'''
+    def install(**kwargs):
+        backend = SimulatedBackend(**kwargs)
+        monkeypatch.setattr(userlib, '_backend', backend)
+        return backend
+
+    return install
+
+
+@pytest.fixture
+def connect():
+    devices = []
+
+    def connect_first():
+        dev = FPSensor().find_devices(timeout=1.0)[0]
+        dev.connect()
+        devices.append(dev)
+        return dev
+
+    yield connect_first
+
+    for dev in devices:
+        dev.stop()
+        dev.disconnect()
+
+
+def test_monitor(simulated, connect):
+    simulated(callback_size=50, callback_period=0)
+    dev = connect()
+    dev.monitor(sample_rate=0.1)
+    wait_count(dev.store, 1000)
+    dev.stop()
+
+    store = dev.store
+    assert store.count % 50 == 0
+    assert len(store.gaps) == 0
+
+    timestamps, values = store.snapshot()[:2]
+    assert values.shape == (3, len(timestamps))
+    assert (np.diff(timestamps) > 0).all()
+
+
+def test_monitor_missed_batches(simulated, connect):
+    simulated(callback_size=20, callback_period=0, drop_probability=0.3)
+    dev = connect()
+    dev.monitor(sample_rate=0.1)
+    wait_count(dev.store, 2000)
+    dev.stop()
+
+    store = dev.store
+    # only whole batches are missed, each marked as a gap
+    assert store.count % 20 == 0
+    assert len(store.gaps) > 0
+    for gap in store.gaps:
+        assert gap.reason.startswith('missed')
+        assert gap.end > gap.start
+
+    timestamps = store.snapshot().timestamps
+    steps = np.diff(timestamps)
+    assert (steps > 0).all()
+    # the missed samples leave holes in the timestamps
+    assert steps.max() > 10 * np.median(steps)
+
+
+def test_poll(simulated, connect):
+    simulated()
+    dev = connect()
+    dev.poll(sample_rate=0.5, block_size=16)
+    wait_count(dev.store, 64)
+    # whole blocks while polling; stop() flushes the last partial one
+    assert dev.store.count % 16 == 0
+    dev.stop()
+
+    store = dev.store
+    assert len(store.gaps) == 0
+    assert (np.diff(store.snapshot().timestamps) > 0).all()
+
+
+def test_poll_failure(simulated, connect, caplog):
+    backend = simulated()
+    dev = connect()
+    dev.poll(sample_rate=0.5, block_size=1000)
+    time.sleep(0.05)
+
+    # the device drops out: polling stops, keeping the samples read
+    backend.disconnect(dev._dev_num)
+    dev._wait(wait_for=10 ** 6)
+    dev._cb_thread.join(5.0)
+    assert not dev._cb_thread.is_alive()
+    assert 0 < dev.store.count < 1000
+    assert 'Polling' in caplog.text
+    backend.connect(dev._dev_num)
+
+
+def test_rescan_keeps_monitored_device(simulated):
+    backend = simulated(num_devices=2, callback_size=20, callback_period=0)
+    sensor = FPSensor()
+    first, second = sensor.find_devices(timeout=1.0)
+    first.connect()
+    try:
+        first.monitor(sample_rate=0.1)
+        wait_count(first.store, 100)
+
+        # discovery now reports the devices the other way around
+        backend.devices.reverse()
+        assert sensor.find_devices(timeout=1.0)[0] is first
+        assert first._dev_num == 0
+        assert second._dev_num == 0
+
+        count = first.store.count
+        wait_count(first.store, count + 100)
+    finally:
+        first.stop()
+        backend.devices.reverse()
+        sensor.find_devices(timeout=1.0)
+        first.disconnect()
+
+
+def test_set_sample_rate_while_monitoring(simulated, connect):
+    simulated(callback_size=20, callback_period=0)
+    dev = connect()
+    dev.monitor(sample_rate=0.1)
+    wait_count(dev.store, 100)
+
+    # the clock is replaced while the ingest thread correlates batches
+    for i in range(200):
+        dev.set_sample_rate(0.1 if i % 2 else 0.2, verify=False)
+
+    count = dev.store.count
+    wait_count(dev.store, count + 1000)
+    assert dev.clock.ready
+
+
+def test_int32_store_range(simulated):
+    # 1 mm offsets and 5 um motion, in nm as the library reports them
+    device = SimulatedDevice(1, '10.0.0.1', offsets=(1e6, -1e6, 0.0),
+                             amplitude=5e3, noise=0.0)
+    simulated(devices=[device], callback_size=20, callback_period=0)
+    dev = FPSensor(store_dtype=np.int32).find_devices(timeout=1.0)[0]
+    dev.connect()
+    try:
+        dev.monitor(sample_rate=0.1)
+        wait_count(dev.store, 1000)
+    finally:
+        dev.stop()
+        dev.disconnect()
+
+    values = dev.store.snapshot().values
+    assert dev.store.clipped == 0
+    motion = values - device.offsets
+    assert np.abs(motion).max() <= 5e3 + 1e-3
+    assert np.ptp(motion[0]) > 5e3
+
+
+def test_consumers(simulated, connect):
+    from fpsensor.derived import Differential
+
+    simulated(callback_size=20, callback_period=0)
+    dev = connect()
+    batches = []
+    fast = dev.add_fast_path(lambda timestamps, values:
+                             batches.append(values.shape))
+    stage = dev.derive([Differential(0, 1)])
+    try:
+        dev.monitor(sample_rate=0.1)
+        wait_count(dev.store, 200)
+        dev.stop()
+    finally:
+        stage.close()
+        dev.remove_fast_path(fast)
+
+    assert fast.stats.count == len(batches) > 0
+    assert batches[0] == (3, 20)
+    assert stage.store.count == dev.store.count
+    assert stage.channel_names[-1] == 'diff01'
@@ -0,0 +1,178 @@
+'''SampleStore ring buffer and lock-free snapshots'''
+import threading
+import time
+
+import numpy as np
+
+from fpsensor.stream import SampleStore
+
+
+def append_indices(store, first, num):
+    '''Append samples whose timestamp and values are their index'''
+    idx = np.arange(first, first + num)
+    store.append(idx.astype(np.float64),
+                 np.vstack([idx, 2 * idx, 3 * idx]).astype(store.dtype))
+
+
+def test_wrap():
+    store = SampleStore(10)
+    append_indices(store, 0, 25)
+    assert store.count == 25
+    assert len(store) == 10
+
+    snap = store.snapshot()
+    assert snap.first == 15
+    assert not snap.overrun
+    np.testing.assert_array_equal(snap.timestamps, np.arange(15, 25))
+    np.testing.assert_array_equal(snap.values[2], 3 * np.arange(15, 25))
+
+
+def test_oversized_batch():
+    store = SampleStore(10)
+    append_indices(store, 0, 3)
+    append_indices(store, 3, 14)
+    snap = store.snapshot()
+    assert snap.first == 7
+    np.testing.assert_array_equal(snap.timestamps, np.arange(7, 17))
+
+
+def test_since():
+    store = SampleStore(10)
+    append_indices(store, 0, 25)
+
+    snap = store.snapshot(since=20)
+    assert (snap.first, snap.overrun) == (20, False)
+    np.testing.assert_array_equal(snap.timestamps, np.arange(20, 25))
+
+    # older samples are gone
+    snap = store.snapshot(since=3)
+    assert (snap.first, snap.overrun) == (15, True)
+    assert len(snap.timestamps) == 10
+
+    snap = store.snapshot(since=25)
+    assert (snap.first, len(snap.timestamps)) == (25, 0)
+
+
+def test_time_range_across_wrap():
+    store = SampleStore(10)
+    append_indices(store, 0, 25)
+
+    # samples 15..19 sit at the end of the arrays, 20..24 at the start
+    for start, stop, expected in [(17, 21.5, np.arange(17, 22)),
+                                  (19.5, 20, [20]),
+                                  (16, 19, np.arange(16, 20)),
+                                  (21, 30, np.arange(21, 25)),
+                                  (0, 14, [])]:
+        snap = store.snapshot(start=start, stop=stop)
+        np.testing.assert_array_equal(snap.timestamps, expected)
+        np.testing.assert_array_equal(snap.values[1], 2 * snap.timestamps)
+
+    snap = store.snapshot(stop=18, num=2)
+    np.testing.assert_array_equal(snap.timestamps, [17, 18])
+    np.testing.assert_array_equal(store.latest(3)[0], [22, 23, 24])
+
+
+def test_trim_overwritten_while_copying(monkeypatch):
+    store = SampleStore(10)
+    append_indices(store, 0, 25)
+    copy = store._copy
+
+    def racing_copy(arr, first, last):
+        # a writer announces three new samples in the middle of the copy
+        store._reserved = store.count + 3
+        return copy(arr, first, last)
+
+    monkeypatch.setattr(store, '_copy', racing_copy)
+    snap = store.snapshot()
+    assert snap.overrun
+    assert snap.first == 18
+    np.testing.assert_array_equal(snap.timestamps, np.arange(18, 25))
+    np.testing.assert_array_equal(snap.values[0], np.arange(18, 25))
+
+    snap = store.snapshot(since=22)
+    assert not snap.overrun
+    np.testing.assert_array_equal(snap.timestamps, [22, 23, 24])
+
+
+def test_retry_on_clear(monkeypatch):
+    store = SampleStore(10)
+    append_indices(store, 0, 25)
+    copy = store._copy
+    clears = []
+
+    def clearing_copy(arr, first, last):
+        if not clears:
+            clears.append(True)
+            store.clear()
+            append_indices(store, 100, 4)
+        return copy(arr, first, last)
+
+    monkeypatch.setattr(store, '_copy', clearing_copy)
+    snap = store.snapshot()
+    # the copy taken across the clear is discarded
+    assert (snap.first, snap.overrun) == (0, False)
+    np.testing.assert_array_equal(snap.timestamps, np.arange(100, 104))
+
+    def always_clearing_copy(arr, first, last):
+        store.clear()
+        return copy(arr, first, last)
+
+    monkeypatch.setattr(store, '_copy', always_clearing_copy)
+    snap = store.snapshot()
+    assert snap.overrun
+    assert len(snap.timestamps) == 0
+
+
+def test_integer_deltas():
+    store = SampleStore(10, dtype=np.int32, scale=1e-6)
+    counts = np.array([[10 ** 12, 10 ** 12 + 5], [0, -7], [3, 2 ** 40]])
+    store.append([0.0, 1.0], counts)
+
+    assert store.clipped == 1
+    timestamps, values = store.latest(raw=True)
+    np.testing.assert_array_equal(values[:2], counts[:2])
+    assert values[2, 1] == 3 + np.iinfo(np.int32).max
+    np.testing.assert_allclose(store.latest()[1][0], [1e6, 1e6 + 5e-6])
+
+
+def test_concurrent_reader():
+    store = SampleStore(1000)
+    done = threading.Event()
+
+    def write():
+        rng = np.random.RandomState(0)
+        index = 0
+        t0 = time.monotonic()
+        while time.monotonic() - t0 < 1.0:
+            num = rng.randint(1, 300)
+            append_indices(store, index, num)
+            index += num
+        done.set()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+
+    reads = torn = 0
+    since = 0
+    while not done.is_set():
+        for snap in (store.snapshot(since=since),
+                     store.snapshot(num=500),
+                     store.snapshot(start=max(0, store.count - 800),
+                                    stop=store.count - 200)):
+            ts = snap.timestamps
+            if not len(ts):
+                continue
+
+            reads += 1
+            expected = np.arange(snap.first, snap.first + len(ts))
+            if not (np.array_equal(ts, expected) and
+                    np.array_equal(snap.values,
+                                   np.vstack([ts, 2 * ts, 3 * ts]))):
+                torn += 1
+
+        snap = store.snapshot(since=since)
+        since = snap.first + len(snap.timestamps)
+
+    writer.join()
+    assert reads > 0
+    assert torn == 0
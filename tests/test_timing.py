@@ -0,0 +1,103 @@
+'''ClockCorrelator fits on synthetic arrival times'''
+import numpy as np
+import pytest
+
+from fpsensor.timing import ClockCorrelator
+
+
+PERIOD = 1e-3
+DRIFT = 50e-6
+ORIGIN = 1000.0
+LATENCY = 2e-4
+
+
+def true_time(index):
+    '''Host time at which the sample index was taken'''
+    return ORIGIN + index * PERIOD * (1 + DRIFT)
+
+
+def arrivals(indices, jitter=0.0, seed=0):
+    '''Arrival times: a constant latency plus exponential delays'''
+    rng = np.random.RandomState(seed)
+    delays = rng.exponential(jitter, len(indices)) if jitter else 0.0
+    return true_time(np.asarray(indices)) + LATENCY + delays
+
+
+def feed(clock, indices, times):
+    for index, host_time in zip(indices, times):
+        clock.update(index, host_time)
+
+
+def test_not_ready():
+    clock = ClockCorrelator()
+    assert not clock.ready
+    with pytest.raises(ValueError):
+        clock.to_host(0)
+
+    # without a nominal period, a single observation is not enough
+    clock.update(0, ORIGIN)
+    assert not clock.ready
+
+
+def test_exact_fit():
+    clock = ClockCorrelator(period=PERIOD, refit_every=1)
+    indices = np.arange(0, 20000, 100)
+    feed(clock, indices, arrivals(indices))
+
+    assert clock.period == pytest.approx(PERIOD * (1 + DRIFT), rel=1e-9)
+    assert clock.drift == pytest.approx(DRIFT, abs=1e-8)
+    assert clock.to_host(50000) == pytest.approx(
+        true_time(50000) + LATENCY, abs=1e-9)
+
+
+def test_jitter_and_outliers():
+    clock = ClockCorrelator(period=PERIOD)
+    indices = np.arange(0, 50000, 100)
+    times = arrivals(indices, jitter=1e-4)
+    # a few very late arrivals, e.g. while the host was busy
+    times[::37] += 0.05
+    feed(clock, indices, times)
+
+    assert clock.drift == pytest.approx(DRIFT, abs=2e-6)
+    # the offset follows the lower envelope: the constant latency remains,
+    # the jitter does not
+    error = clock.to_host(indices[-1]) - (true_time(indices[-1]) + LATENCY)
+    assert 0.0 <= error < 2e-5
+    assert clock.jitter < 1e-3
+    assert clock.resets == 0
+
+
+def test_nominal_period_until_fitted():
+    clock = ClockCorrelator(period=PERIOD, min_points=8)
+    clock.update(100, ORIGIN)
+    assert clock.ready
+    assert clock.period == PERIOD
+    assert clock.to_host(200) == pytest.approx(ORIGIN + 100 * PERIOD)
+
+
+def test_step_restarts_fit():
+    clock = ClockCorrelator(period=PERIOD, max_step=0.1)
+    indices = np.arange(0, 20000, 100)
+    feed(clock, indices, arrivals(indices, jitter=1e-5))
+    assert clock.resets == 0
+
+    # e.g. the device restarted: indices jump back, time goes on
+    later = np.arange(0, 10000, 100)
+    times = arrivals(later) + 60.0
+    feed(clock, later, times)
+    assert clock.resets == 1
+    assert clock.count == len(later)
+    assert clock.to_host(later[-1]) == pytest.approx(times[-1], abs=1e-6)
+
+
+def test_fit_snapshot():
+    clock = ClockCorrelator(period=PERIOD)
+    indices = np.arange(0, 2000, 100)
+    feed(clock, indices, arrivals(indices))
+    fit = clock.fit
+
+    clock.reset()
+    assert clock.fit is None
+    # a fit read earlier keeps converting consistently
+    assert clock.to_host(indices[-1], fit=fit) == pytest.approx(
+        arrivals(indices[-1:])[0], abs=1e-9)
@@ -0,0 +1,50 @@
+'''Throughput benchmark of the userlib interface on the simulated backend
+
+No hardware or vendor library is required.
+'''
+from __future__ import print_function
+import argparse
+import time
+
+from fpsensor.userlib import (FPSensor, set_backend)
+from fpsensor.userlib.sim import SimulatedBackend
+
+
+def run(sample_rate, callback_size, callback_period, duration, poll=False):
+    set_backend(SimulatedBackend(callback_size=callback_size,
+                                 callback_period=callback_period))
+
+    fps = FPSensor()
+    dev = fps.find_devices()[0]
+    dev.connect()
+
+    t0 = time.time()
+    if poll:
+        dev.poll(sample_rate=sample_rate)
+    else:
+        dev.monitor(sample_rate=sample_rate)
+    time.sleep(duration)
+    dev.stop()
+    elapsed = time.time() - t0
+
+    count = dev.store.count
+    print('{} samples in {:.2f} s: {:.0f} samples/s'
+          ''.format(count, elapsed, count / elapsed))
+    dev.disconnect()
+    return count / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sample-rate', type=float, default=2. * 0.3277,
+                        help='sample period [ms]')
+    parser.add_argument('--callback-size', type=int, default=100)
+    parser.add_argument('--callback-period', type=float, default=None,
+                        help='seconds between callbacks (0: no delay)')
+    parser.add_argument('--duration', type=float, default=2.0)
+    parser.add_argument('--poll', action='store_true',
+                        help='benchmark the polling mode instead')
+    args = parser.parse_args()
+
+    run(args.sample_rate, args.callback_size, args.callback_period,
+        args.duration, poll=args.poll)
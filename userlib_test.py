@@ -74,10 +74,9 @@ def plot_loop(dev):
 
     np.save('test', data)
     for i in range(3):
-        print('average position (ax=%d)' % i, np.average(dev._positions[i]))
+        print('average position (ax=%d)' % i, np.average(data[i + 1, :]))
     # print('total positions in %g seconds: %d' % (t1 - t0, len(data[0, :])))
     # print('sample rate %f (%d)' % (dev.sample_rate, dev._sample_rate))
-    dev._positions = [[] for i in range(3)]
 
 
 if __name__ == '__main__':